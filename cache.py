@@ -0,0 +1,263 @@
+"""
+Cachés en memoria para el pipeline de búsqueda
+Acotadas (LRU) y seguras entre threads del executor
+"""
+
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from types import MappingProxyType
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizar texto para usarlo como clave de caché
+
+    Example:
+        >>> normalize_text("  Correo de ENFERMERÍA ")
+        'correo de enfermeria'
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class EmbeddingCache:
+    """Caché LRU de embeddings de consultas, con contadores de aciertos/fallos"""
+
+    def __init__(self, max_size: int = 2048):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, model, texts):
+        """
+        Equivalente a model.encode(texts) pasando por la caché
+
+        Los textos que no están en caché se codifican juntos en una sola
+        llamada al modelo.
+
+        Returns:
+            Matriz (len(texts), dim) float32 nueva (se puede modificar)
+        """
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            # Se codifica el primer texto original de cada clave
+            self._fill(vectors, missing, model.encode([texts[positions[0]] for positions in missing.values()]))
+        return np.vstack(vectors)
+
+    async def encode_async(self, batcher, texts):
+        """encode() desde el event loop: los textos nuevos van a batcher.encode_async()"""
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            self._fill(vectors, missing,
+                       await batcher.encode_async([texts[positions[0]] for positions in missing.values()]))
+        return np.vstack(vectors)
+
+    def _lookup(self, texts):
+        keys = [normalize_text(t) for t in texts]
+        vectors = [None] * len(keys)
+        missing = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    vectors[i] = vector
+                    self.hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+                    self.misses += 1
+        return keys, vectors, missing
+
+    def _fill(self, vectors, missing, encoded):
+        encoded = np.asarray(encoded, dtype='float32')
+
+        with self._lock:
+            for (key, positions), vector in zip(missing.items(), encoded):
+                vector = vector.copy()
+                vector.setflags(write=False)
+                self._entries[key] = vector
+                self._entries.move_to_end(key)
+                for i in positions:
+                    vectors[i] = vector
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+class TTLCache:
+    """Caché LRU con expiración por entrada (TTL en segundos)"""
+
+    def __init__(self, max_size: int = 1000, ttl: float = 900):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Valor cacheado o None si no existe o expiró"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+def freeze(value):
+    """
+    Copia inmutable (recursiva) de resultados para compartirlos desde caché
+
+    dict -> MappingProxyType, list/tuple -> tuple
+    """
+    if isinstance(value, (dict, MappingProxyType)):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class SemanticAnswerCache:
+    """
+    Caché de respuestas del LLM por similitud de la consulta
+
+    Una respuesta se reutiliza si la nueva consulta está a una distancia
+    coseno <= max_distance de una consulta cacheada Y recupera exactamente
+    el mismo conjunto de documentos, con la misma versión de la KB.
+    """
+
+    def __init__(self, max_size: int = 500, ttl: float = 3600, max_distance: float = 0.05):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._matrix = None
+        self._matrix_ids = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype='float32').ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _rebuild_matrix(self):
+        self._matrix_ids = list(self._entries.keys())
+        if self._matrix_ids:
+            self._matrix = np.vstack([self._entries[i]['vector'] for i in self._matrix_ids])
+        else:
+            self._matrix = None
+
+    def lookup(self, vector, doc_ids, kb_version):
+        """Respuesta cacheada o None"""
+        vector = self._normalize(vector)
+        doc_set = frozenset(doc_ids)
+        now = time.monotonic()
+
+        with self._lock:
+            if self._matrix is None and self._entries:
+                self._rebuild_matrix()
+            if self._matrix is not None:
+                distances = 1.0 - self._matrix @ vector
+                for pos in np.argsort(distances):
+                    if distances[pos] > self.max_distance:
+                        break
+                    entry = self._entries.get(self._matrix_ids[pos])
+                    if entry is None or entry['expires_at'] <= now:
+                        continue
+                    if entry['kb_version'] == kb_version and entry['doc_ids'] == doc_set:
+                        self._entries.move_to_end(self._matrix_ids[pos])
+                        self.hits += 1
+                        return entry['answer']
+            self.misses += 1
+            return None
+
+    def store(self, vector, doc_ids, answer, kb_version):
+        with self._lock:
+            now = time.monotonic()
+            expired = [k for k, e in self._entries.items() if e['expires_at'] <= now]
+            for k in expired:
+                del self._entries[k]
+
+            self._entries[self._next_id] = {
+                'vector': self._normalize(vector),
+                'doc_ids': frozenset(doc_ids),
+                'answer': answer,
+                'kb_version': kb_version,
+                'expires_at': now + self.ttl
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
@@ -0,0 +1,244 @@
+"""
+Persistencia de conversaciones en PostgreSQL (asyncpg)
+Escritura por lotes en segundo plano + historial reciente en memoria
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+# Un solo statement por lote: upsert de usuarios + inserción multi-fila.
+# created_at se calcula por fila (clock_timestamp() menos la espera en cola)
+# para conservar el orden real de los turnos dentro del lote.
+INSERT_BATCH_SQL = """
+    WITH batch AS (
+        SELECT *
+        FROM unnest($1::text[], $2::text[], $3::text[], $4::text[],
+                    $5::int[], $6::int[], $7::float8[])
+             WITH ORDINALITY
+             AS b(phone_number, user_message, bot_response, model_used,
+                  response_time_ms, context_length, queued_s, ord)
+    ),
+    upserted AS (
+        INSERT INTO users (phone_number)
+        SELECT DISTINCT phone_number FROM batch
+        ON CONFLICT (phone_number)
+        DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+        RETURNING id, phone_number
+    )
+    INSERT INTO conversations
+        (user_id, phone_number, user_message, bot_response,
+         model_used, response_time_ms, context_length, created_at)
+    SELECT u.id, b.phone_number, b.user_message, b.bot_response,
+           b.model_used, b.response_time_ms, b.context_length,
+           clock_timestamp() - make_interval(secs => b.queued_s)
+    FROM batch b
+    JOIN upserted u USING (phone_number)
+    ORDER BY b.ord
+"""
+
+
+class ConversationWriteBuffer:
+    """
+    Buffer de escritura (write-behind) para la tabla conversations
+
+    Las filas se acumulan en una cola acotada y se escriben cada
+    `flush_interval` segundos o cada `max_batch` filas, lo que ocurra
+    primero, en una sola transacción. Si la cola se llena, add() espera
+    (backpressure) en lugar de crear tareas sin límite.
+    """
+
+    def __init__(self, flush_interval: float = 0.2, max_batch: int = 200, max_queue: int = 5000):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.pool = None
+        self._queue = None
+        self._task = None
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def start(self, pool):
+        """Lanzar el flusher en el event loop actual"""
+        self.pool = pool
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"🗄️ Escritura por lotes: cada {self.flush_interval * 1000:.0f}ms o {self.max_batch} filas")
+
+    async def add(self, phone, user_msg, bot_msg, model, response_time):
+        """Encolar una conversación (espera solo si la cola está llena)"""
+        if self._queue is None:
+            logger.error("❌ Buffer de conversaciones no iniciado")
+            return
+        await self._queue.put(
+            (phone, user_msg, bot_msg, model, int(response_time), len(user_msg), time.monotonic())
+        )
+
+    async def stop(self):
+        """Escribir lo pendiente y detener el flusher"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        logger.info(f"🗄️ Buffer de conversaciones vaciado: {self.stats()}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+        # Drenar lo que quede en cola al apagar
+        remaining = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        for i in range(0, len(remaining), self.max_batch):
+            await self._flush(remaining[i:i + self.max_batch])
+
+    async def _flush(self, batch):
+        now = time.monotonic()
+        columns = list(zip(*batch))
+        queued_s = [now - enqueued_at for enqueued_at in columns[6]]
+
+        start = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute(INSERT_BATCH_SQL, *[list(c) for c in columns[:6]], queued_s)
+            self.rows_written += len(batch)
+        except Exception as e:
+            self.rows_failed += len(batch)
+            logger.error(f"❌ Error guardando lote de {len(batch)} conversaciones: {e}")
+            return
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.flushes += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+        logger.debug(f"🗄️ Lote de {len(batch)} conversaciones guardado en {elapsed_ms:.1f}ms")
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize() if self._queue else 0,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'rows_failed': self.rows_failed,
+            'last_flush_ms': round(self.last_flush_ms, 1),
+            'avg_flush_ms': round(self._total_flush_ms / self.flushes, 1) if self.flushes else 0.0,
+            'max_flush_ms': round(self.max_flush_ms, 1)
+        }
+
+
+class HistoryCache:
+    """
+    Últimos turnos (usuario, asistente) por teléfono, en memoria
+
+    Se alimenta al guardar cada conversación y solo consulta PostgreSQL la
+    primera vez que se lee un usuario (o tras expirar). Acotado en número de
+    usuarios (LRU) y en antigüedad (ttl = timeout de inactividad).
+    """
+
+    def __init__(self, max_turns: int = 5, max_users: int = 10000, ttl: float = 1800):
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.ttl = ttl
+        # phone -> {'turns': deque, 'hydrated': bool, 'last_access': float}
+        self._users = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, phone, create=False):
+        now = time.monotonic()
+        entry = self._users.get(phone)
+        if entry is not None and now - entry['last_access'] > self.ttl:
+            del self._users[phone]
+            entry = None
+
+        if entry is None and create:
+            entry = {'turns': deque(maxlen=self.max_turns), 'hydrated': False, 'last_access': now}
+            self._users[phone] = entry
+
+        if entry is not None:
+            entry['last_access'] = now
+            self._users.move_to_end(phone)
+            self._evict(now)
+        return entry
+
+    def _evict(self, now):
+        while self._users:
+            oldest = next(iter(self._users.values()))
+            if len(self._users) > self.max_users or now - oldest['last_access'] > self.ttl:
+                self._users.popitem(last=False)
+            else:
+                break
+
+    def get(self, phone):
+        """Turnos en orden cronológico, o None si hay que hidratar desde la DB"""
+        entry = self._entry(phone)
+        if entry is None or not entry['hydrated']:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return list(entry['turns'])
+
+    def append(self, phone, user_msg, bot_msg):
+        """Registrar un turno recién respondido"""
+        self._entry(phone, create=True)['turns'].append((user_msg, bot_msg))
+
+    def hydrate(self, phone, db_turns):
+        """
+        Completar con los turnos leídos de la DB (orden cronológico)
+
+        Los turnos escritos en memoria que aún no llegaron a la DB (buffer de
+        escritura) se conservan al final sin duplicarse.
+        """
+        entry = self._entry(phone, create=True)
+        recent = list(entry['turns'])
+        merged = [turn for turn in db_turns if turn not in recent] + recent
+
+        entry['turns'] = deque(merged[-self.max_turns:], maxlen=self.max_turns)
+        entry['hydrated'] = True
+        return list(entry['turns'])
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'users': len(self._users),
+            'max_users': self.max_users,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
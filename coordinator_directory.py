@@ -0,0 +1,134 @@
+"""
+Respuestas directas para consultas de contacto de coordinadores
+"correo/teléfono/horario de <facultad>" se responde con los campos que
+ingest.py (process_coordinadores_file) guarda en 'metadata', sin búsqueda
+vectorial ni llamada al LLM.
+"""
+
+import re
+
+from cache import normalize_text
+
+# Campo de metadata -> palabras que lo piden (texto normalizado, sin tildes)
+FIELD_KEYWORDS = {
+    'email': ['correo', 'correos', 'email', 'e-mail', 'mail', 'gmail'],
+    'telefono': ['telefono', 'celular', 'numero', 'whatsapp', 'llamar'],
+    'horario': ['horario', 'horarios', 'hora de atencion', 'atienden', 'atencion'],
+    'ubicacion': ['ubicacion', 'donde queda', 'donde esta', 'donde se encuentra', 'oficina', 'direccion'],
+}
+# Piden el contacto completo
+CONTACT_KEYWORDS = ['coordinador', 'coordinadora', 'coordinacion', 'contacto', 'encargado', 'encargada']
+# Consultas de coordinador que no son de contacto (líneas, formatos): siguen el flujo RAG
+EXCLUDE_KEYWORDS = ['linea', 'lineas', 'sublinea', 'investigaciones', 'formato', 'reglamento', 'tesis']
+
+_SMALL_WORDS = {'de', 'la', 'y', 'e', 'del'}
+
+
+def _alternation(phrases):
+    """Regex con las frases completas; las más largas primero (ganan al solaparse)"""
+    ordered = sorted(set(phrases), key=len, reverse=True)
+    return re.compile(r'\b(' + '|'.join(re.escape(p) for p in ordered) + r')\b')
+
+
+def faculty_display_name(facultad: str) -> str:
+    """FACULTAD_DE_CIENCIAS_AGRARIAS -> Facultad de Ciencias Agrarias"""
+    words = facultad.lower().split('_')
+    return ' '.join(w if i and w in _SMALL_WORDS else w.capitalize() for i, w in enumerate(words))
+
+
+class CoordinatorDirectory:
+    """
+    Índice en memoria facultad/alias -> metadata del coordinador
+
+    match() detecta campo + facultad; render() arma la respuesta de
+    WhatsApp. Los contadores se conservan al recargar la base con load().
+    """
+
+    def __init__(self):
+        self.records = {}
+        self._alias_to_faculty = {}
+        self._alias_pattern = None
+        self._field_patterns = {field: _alternation(words) for field, words in FIELD_KEYWORDS.items()}
+        self._contact_pattern = _alternation(CONTACT_KEYWORDS)
+        self._exclude_pattern = _alternation(EXCLUDE_KEYWORDS)
+
+        self.messages = 0
+        self.served = 0
+
+    def load(self, docs):
+        """Indexar los documentos tipo 'coordinador' (con metadata) de la base"""
+        records, aliases = {}, {}
+        for doc in docs:
+            if doc.get('type') != 'coordinador' or not doc.get('metadata'):
+                continue
+            facultad = doc.get('facultad', '')
+            records[facultad] = dict(doc['metadata'])
+
+            names = [faculty_display_name(facultad).lower().replace('facultad de ', '', 1)]
+            names += (doc['metadata'].get('alias') or '').split(',')
+            for name in names:
+                name = normalize_text(name)
+                if name:
+                    aliases.setdefault(name, set()).add(facultad)
+
+        # Alias compartidos (p. ej. "sistemas") no identifican una facultad
+        self._alias_to_faculty = {name: next(iter(f)) for name, f in aliases.items() if len(f) == 1}
+        self._alias_pattern = _alternation(self._alias_to_faculty) if self._alias_to_faculty else None
+        self.records = records
+        return len(records)
+
+    def match(self, query: str):
+        """
+        Returns:
+            (facultad, campos pedidos) o None si no es una consulta de contacto
+            de una sola facultad
+        """
+        self.messages += 1
+        if self._alias_pattern is None:
+            return None
+
+        text = normalize_text(query)
+        if self._exclude_pattern.search(text):
+            return None
+
+        fields = [field for field, pattern in self._field_patterns.items() if pattern.search(text)]
+        if not fields and not self._contact_pattern.search(text):
+            return None
+
+        faculties = {self._alias_to_faculty[m] for m in self._alias_pattern.findall(text)}
+        if len(faculties) != 1:
+            return None
+        return faculties.pop(), fields
+
+    def render(self, facultad: str, fields) -> str:
+        """Respuesta con el coordinador y los campos pedidos (todos si no pidió uno concreto)"""
+        self.served += 1
+        record = self.records[facultad]
+        fields = fields or list(FIELD_KEYWORDS)
+
+        lines = [f"🏫 *{faculty_display_name(facultad)}*"]
+        if record.get('nombre'):
+            lines.append(f"👨‍💼 Coordinador: {record['nombre']}")
+        if 'email' in fields and record.get('email'):
+            lines.append(f"📧 Email: {record['email']}")
+            if record.get('email_alternativo'):
+                lines.append(f"📧 Email alternativo: {record['email_alternativo']}")
+        if 'telefono' in fields and record.get('telefono'):
+            lines.append(f"📱 Teléfono: {record['telefono']}")
+        if 'horario' in fields:
+            if record.get('horario'):
+                lines.append(f"🕐 Horario: {record['horario']}")
+            if record.get('atencion'):
+                lines.append(f"📅 Atención: {record['atencion']}")
+        if 'ubicacion' in fields and record.get('ubicacion'):
+            lines.append(f"📍 Ubicación: {record['ubicacion']}")
+
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        return {
+            'coordinators': len(self.records),
+            'messages': self.messages,
+            'served': self.served,
+            'share': round(self.served / self.messages, 3) if self.messages else 0.0
+        }
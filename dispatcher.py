@@ -0,0 +1,133 @@
+"""
+Despacho de mensajes entrantes por usuario
+Una cola ordenada por número, concurrencia global acotada y agrupación
+de mensajes seguidos del mismo usuario en una sola llamada
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UserDispatcher:
+    """
+    Cola por usuario + pool de workers
+
+    - Los mensajes de un mismo número se procesan de a uno y en orden.
+    - Los usuarios con trabajo pendiente esperan en una cola FIFO, así que
+      cada usuario recibe un turno antes de que otro repita (round-robin).
+    - Los mensajes que llegan mientras el usuario espera o está siendo
+      atendido se agrupan en un único texto (una sola llamada al LLM).
+    """
+
+    def __init__(self, handler: Callable[[str, str, List[str]], Awaitable[None]],
+                 workers: int = 100, coalesce_window: float = 0.5,
+                 max_batch: int = 5):
+        """
+        Args:
+            handler: async def handler(phone, texto, message_ids)
+            workers: Usuarios atendidos en paralelo como máximo
+            coalesce_window: Segundos a esperar desde el último mensaje del
+                usuario antes de procesarlo, para agrupar ráfagas
+            max_batch: Mensajes máximos agrupados en una llamada
+        """
+        self.handler = handler
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.max_batch = max_batch
+
+        self._pending: Dict[str, deque] = {}
+        self._last_arrival: Dict[str, float] = {}
+        self._scheduled = set()
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+        self.messages_received = 0
+        self.batches_processed = 0
+        self.messages_coalesced = 0
+
+    def start(self):
+        """Lanzar los workers en el event loop actual"""
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"👷 Dispatcher iniciado: {self.workers} workers, ventana {self.coalesce_window}s")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, phone: str, text: str, message_id: Optional[str] = None):
+        """Encolar un mensaje (no bloquea)"""
+        self._pending.setdefault(phone, deque()).append((text, message_id))
+        self._last_arrival[phone] = time.monotonic()
+        self.messages_received += 1
+
+        # Un usuario está en la cola de listos (o en un worker) una sola vez
+        if phone not in self._scheduled:
+            self._scheduled.add(phone)
+            self._ready.put_nowait(phone)
+
+    def _take_batch(self, phone: str):
+        """Sacar el siguiente lote: mensajes normales seguidos, o un comando solo"""
+        queue = self._pending[phone]
+        texts, message_ids = [], []
+
+        while queue and len(texts) < self.max_batch:
+            text, message_id = queue[0]
+            is_command = text.startswith('/')
+            if is_command and texts:
+                break
+            queue.popleft()
+            texts.append(text)
+            if message_id:
+                message_ids.append(message_id)
+            if is_command:
+                break
+
+        return "\n".join(texts), message_ids, len(texts)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            phone = await self._ready.get()
+            try:
+                # Esperar a que el usuario termine su ráfaga
+                wait = self._last_arrival.get(phone, 0) + self.coalesce_window - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                text, message_ids, count = self._take_batch(phone)
+                self.batches_processed += 1
+                if count > 1:
+                    self.messages_coalesced += count - 1
+                    logger.info(f"🧩 {count} mensajes de {phone} agrupados en una llamada")
+
+                await self.handler(phone, text, message_ids)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error en worker {worker_id} para {phone}: {e}", exc_info=True)
+
+            finally:
+                # Si quedó trabajo, el usuario vuelve al final de la cola
+                if self._pending.get(phone):
+                    self._ready.put_nowait(phone)
+                else:
+                    self._pending.pop(phone, None)
+                    self._last_arrival.pop(phone, None)
+                    self._scheduled.discard(phone)
+
+    def stats(self) -> dict:
+        return {
+            'users_pending': len(self._scheduled),
+            'messages_pending': sum(len(q) for q in self._pending.values()),
+            'messages_received': self.messages_received,
+            'batches_processed': self.batches_processed,
+            'messages_coalesced': self.messages_coalesced
+        }
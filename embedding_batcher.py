@@ -0,0 +1,253 @@
+"""
+Micro-batching de embeddings dentro del proceso del bot
+Agrupa las consultas concurrentes en una sola pasada del modelo
+
+Benchmark:
+    python embedding_batcher.py [--window-ms 5] [--max-batch 64]
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from retrieval_pool import RetrievalOverloaded
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    Fachada con la misma interfaz que model.encode(texts)
+
+    Las peticiones que llegan (desde el event loop con encode_async() o
+    desde threads con encode()) se acumulan durante `window_ms` o hasta
+    `max_batch` textos y se codifican juntas en un thread propio; cada
+    llamador recibe solo sus filas. main.py codifica desde el event loop,
+    así el lote no queda limitado al número de threads de búsqueda.
+    Después de close() se codifica directamente, sin agrupar.
+
+    Con `max_pending` > 0, si ya hay esa cantidad de peticiones esperando
+    al modelo se lanza RetrievalOverloaded (descarte de carga, igual que
+    RetrievalExecutor) en vez de dejar crecer la cola.
+    """
+
+    def __init__(self, model=None, window_ms: float = 5, max_batch: int = 64, max_pending: int = 0):
+        self.model = model
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._pending = []
+        self._direct_inflight = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._last_requests = 0
+
+        self.batches = 0
+        self.texts_encoded = 0
+        self.largest_batch = 0
+        self.rejected = 0
+
+    @property
+    def backlog(self) -> int:
+        """Peticiones esperando o en curso fuera del event loop"""
+        return len(self._pending) + self._direct_inflight
+
+    def _admit(self):
+        if self.max_pending and self.backlog >= self.max_pending:
+            self.rejected += 1
+            raise RetrievalOverloaded(f"{self.backlog} embeddings en cola")
+
+    def _enqueue(self, texts):
+        """Future encolado en el thread del batcher, o None si no se agrupa"""
+        if not texts or self.window <= 0:
+            return None
+        with self._cond:
+            if self._closed:
+                return None
+            self._admit()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+                self._thread.start()
+            future = Future()
+            self._pending.append((texts, future))
+            self._cond.notify()
+            return future
+
+    def _encode_direct(self, texts):
+        return np.asarray(self.model.encode(texts), dtype='float32')
+
+    def submit(self, texts) -> Future:
+        """Encolar textos; el Future se resuelve con su matriz (n, dim)"""
+        texts = list(texts)
+        future = self._enqueue(texts)
+        if future is not None:
+            return future
+
+        # Sin ventana (o cerrado) no hay nada que agrupar: en el thread que llama
+        future = Future()
+        try:
+            future.set_result(self._encode_direct(texts))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def encode(self, texts):
+        """Bloqueante, para código en threads (executor de búsqueda)"""
+        return self.submit(texts).result()
+
+    async def encode_async(self, texts):
+        """Desde el event loop; sin agrupar, el modelo corre en el executor por defecto"""
+        texts = list(texts)
+        future = self._enqueue(texts)
+        if future is None:
+            self._admit()
+            self._direct_inflight += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(None, self._encode_direct, texts)
+            finally:
+                self._direct_inflight -= 1
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _take_batch(self):
+        """Esperar la ventana y sacar peticiones hasta max_batch textos"""
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+
+            # Tráfico suelto (una petición ahora y en el lote anterior): sin
+            # esperar la ventana; con concurrencia, se espera para agrupar
+            wait = self.window if len(self._pending) > 1 or self._last_requests > 1 else 0
+            deadline = time.monotonic() + wait
+            while sum(len(t) for t, _ in self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+
+            batch, count = [], 0
+            # Siempre al menos una petición, aunque sola supere max_batch
+            while self._pending and (not batch or count + len(self._pending[0][0]) <= self.max_batch):
+                texts, future = self._pending.pop(0)
+                batch.append((texts, future))
+                count += len(texts)
+            self._last_requests = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+
+            all_texts = [text for texts, _ in batch for text in texts]
+            try:
+                vectors = np.asarray(self.model.encode(all_texts), dtype='float32')
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for texts, future in batch:
+                future.set_result(vectors[offset:offset + len(texts)])
+                offset += len(texts)
+
+            self.batches += 1
+            self.texts_encoded += len(all_texts)
+            self.largest_batch = max(self.largest_batch, len(all_texts))
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'texts_encoded': self.texts_encoded,
+            'avg_batch': round(self.texts_encoded / self.batches, 1) if self.batches else 0.0,
+            'largest_batch': self.largest_batch,
+            'pending': self.backlog,
+            'rejected': self.rejected
+        }
+
+
+async def _run_clients(encode, workload, concurrency):
+    """`concurrency` corrutinas (mensajes en curso) codificando una consulta a la vez"""
+    queue = list(workload)
+
+    async def client():
+        while queue:
+            await encode(queue.pop())
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+def benchmark(model, queries, concurrency_levels=(1, 10, 50, 100), window_ms=5, max_batch=64, workers=4):
+    """
+    Consultas/segundo con y sin micro-batching para cada nivel de concurrencia
+
+    Como en main.py: `concurrency` mensajes en el event loop. 'directo'
+    codifica cada consulta en un pool de `workers` threads (el executor de
+    búsqueda); 'batch' usa encode_async() del batcher.
+    """
+    rows = []
+    for concurrency in concurrency_levels:
+        n = max(len(queries), concurrency * 4)
+        workload = [queries[i % len(queries)] for i in range(n)]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            async def direct(query):
+                await asyncio.get_running_loop().run_in_executor(pool, model.encode, [query])
+
+            start = time.perf_counter()
+            asyncio.run(_run_clients(direct, workload, concurrency))
+            elapsed = time.perf_counter() - start
+        rows.append((concurrency, 'directo', n / elapsed, elapsed * 1000 / n, 1.0))
+
+        batcher = EmbeddingBatcher(model, window_ms, max_batch)
+        start = time.perf_counter()
+        asyncio.run(_run_clients(lambda q: batcher.encode_async([q]), workload, concurrency))
+        elapsed = time.perf_counter() - start
+        batcher.close()
+        rows.append((concurrency, 'batch', n / elapsed, elapsed * 1000 / n, batcher.stats()['avg_batch']))
+
+    print(f"{'concurrencia':>12} {'modo':>8} {'consultas/s':>12} {'ms/consulta':>12} {'lote medio':>11}")
+    for concurrency, label, qps, ms, avg_batch in rows:
+        print(f"{concurrency:>12} {label:>8} {qps:>12.1f} {ms:>12.2f} {avg_batch:>11.1f}")
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    from sentence_transformers import SentenceTransformer
+
+    parser = argparse.ArgumentParser(description='Benchmark de micro-batching de embeddings')
+    parser.add_argument('--window-ms', type=float, default=5)
+    parser.add_argument('--max-batch', type=int, default=64)
+    args = parser.parse_args()
+
+    sample_queries = [
+        "correo de la facultad de enfermería",
+        "líneas de investigación de ingeniería civil",
+        "cómo presento mi proyecto de tesis",
+        "coordinador de investigación de ciencias contables",
+        "requisitos para sustentar la tesis",
+        "formato de borrador de tesis",
+        "sublíneas de medicina veterinaria",
+        "contacto del vicerrectorado de investigación",
+    ]
+
+    benchmark(
+        SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2'),
+        sample_queries,
+        window_ms=args.window_ms,
+        max_batch=args.max_batch
+    )
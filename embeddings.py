@@ -0,0 +1,210 @@
+"""
+Backends de embeddings para main.py e ingest.py
+torch (por defecto), ONNX Runtime y ONNX cuantizado a int8 (dinámico)
+
+Todos devuelven un objeto con encode(texts) compatible con SentenceTransformer.
+Requiere sentence-transformers >= 3.2 con el extra [onnx] para los backends ONNX.
+
+Paridad y latencia frente a torch:
+    python embeddings.py --backends onnx onnx-int8
+"""
+
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+EMBEDDING_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+# Configuración de cuantización de optimum: avx2, avx512, avx512_vnni, arm64
+ONNX_QUANTIZATION = os.getenv('ONNX_QUANTIZATION', 'avx2')
+EMBEDDING_MODELS_DIR = os.getenv('EMBEDDING_MODELS_DIR', 'models')
+
+
+def _snapshot_dir(model_name, suffix=''):
+    return Path(EMBEDDING_MODELS_DIR) / f"{model_name.split('/')[-1]}{suffix}"
+
+
+def _load_torch(model_name):
+    """
+    Modelo torch desde la copia local en EMBEDDING_MODELS_DIR
+
+    La primera carga (p. ej. ingest.py durante el build) descarga del hub y
+    guarda la copia; los arranques siguientes no tocan la red.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    local_dir = _snapshot_dir(model_name)
+    if (local_dir / 'modules.json').exists():
+        return SentenceTransformer(str(local_dir))
+
+    model = SentenceTransformer(model_name)
+    try:
+        model.save(str(local_dir))
+        logger.info(f"💾 Modelo guardado en {local_dir}")
+    except OSError as e:
+        logger.warning(f"⚠️ No se pudo guardar el modelo en {local_dir}: {e}")
+    return model
+
+
+def _load_onnx(model_name):
+    """
+    Modelo ONNX desde la copia local en EMBEDDING_MODELS_DIR
+
+    Como _load_torch: la primera carga exporta a ONNX desde el hub y guarda
+    la copia; los arranques siguientes no tocan la red.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    local_dir = _snapshot_dir(model_name, '-onnx')
+    if (local_dir / 'onnx' / 'model.onnx').exists():
+        return SentenceTransformer(str(local_dir), backend='onnx')
+
+    logger.info(f"🔧 Exportando {model_name} a ONNX en {local_dir}...")
+    model = SentenceTransformer(model_name, backend='onnx')
+    try:
+        model.save(str(local_dir))
+        logger.info(f"💾 Modelo ONNX guardado en {local_dir}")
+    except OSError as e:
+        logger.warning(f"⚠️ No se pudo guardar el modelo en {local_dir}: {e}")
+    return model
+
+
+def _load_quantized(model_name):
+    """Modelo ONNX int8; se exporta y cuantiza la primera vez en EMBEDDING_MODELS_DIR"""
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    local_dir = _snapshot_dir(model_name, '-onnx')
+    file_suffix = f"qint8_{ONNX_QUANTIZATION}"
+    file_name = f"onnx/model_{file_suffix}.onnx"
+
+    if not (local_dir / file_name).exists():
+        # Parte de la copia ONNX local (la exporta si aún no existe)
+        model = _load_onnx(model_name)
+        logger.info(f"🔧 Cuantizando {model_name} a int8 ({ONNX_QUANTIZATION}) en {local_dir}...")
+        export_dynamic_quantized_onnx_model(
+            model, ONNX_QUANTIZATION, str(local_dir), file_suffix=file_suffix
+        )
+
+    return SentenceTransformer(str(local_dir), backend='onnx', model_kwargs={'file_name': file_name})
+
+
+def load_embedding_model(backend='torch', model_name=MODEL_NAME):
+    """
+    Cargar el modelo de embeddings con el backend indicado
+
+    Raises:
+        ValueError: backend desconocido
+        ImportError: faltan onnxruntime/optimum para los backends ONNX
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Backend de embeddings no soportado: {backend}")
+
+    if backend == 'torch':
+        return _load_torch(model_name)
+    if backend == 'onnx':
+        return _load_onnx(model_name)
+    return _load_quantized(model_name)
+
+
+def _normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype='float32')
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def cosine_agreement(reference, candidate) -> dict:
+    """Similitud coseno fila a fila entre dos matrices de embeddings"""
+    cosines = np.sum(_normalize_rows(reference) * _normalize_rows(candidate), axis=1)
+    return {
+        'n': int(len(cosines)),
+        'mean': float(cosines.mean()),
+        'min': float(cosines.min()),
+        'p01': float(np.percentile(cosines, 1))
+    }
+
+
+def parity_check(reference_model, candidate_model, texts, batch_size=64) -> dict:
+    """Acuerdo coseno entre dos backends sobre los mismos textos"""
+    reference = reference_model.encode(texts, batch_size=batch_size)
+    candidate = candidate_model.encode(texts, batch_size=batch_size)
+    return cosine_agreement(reference, candidate)
+
+
+def index_parity(model, index, texts, sample=64) -> dict:
+    """
+    Acuerdo entre el modelo y los vectores guardados en el índice FAISS
+
+    Solo para índices que permiten reconstruct() (flat, HNSW). Devuelve None
+    si el índice no guarda los vectores originales (IVF-PQ).
+    """
+    ids = np.linspace(0, min(len(texts), index.ntotal) - 1, num=min(sample, len(texts)), dtype='int64')
+    ids = np.unique(ids)
+    try:
+        stored = np.vstack([index.reconstruct(int(i)) for i in ids])
+    except RuntimeError:
+        return None
+    return cosine_agreement(stored, model.encode([texts[i] for i in ids]))
+
+
+def latency_benchmark(model, queries, runs=3, batch_size=32) -> dict:
+    """ms por consulta individual (p50/p95) y consultas/s en lotes"""
+    model.encode(queries[:2])  # calentamiento
+
+    single_ms = []
+    for _ in range(runs):
+        for query in queries:
+            start = time.perf_counter()
+            model.encode([query])
+            single_ms.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        model.encode(queries, batch_size=batch_size)
+    batch_qps = runs * len(queries) / (time.perf_counter() - start)
+
+    return {
+        'p50_ms': float(np.percentile(single_ms, 50)),
+        'p95_ms': float(np.percentile(single_ms, 95)),
+        'batch_qps': float(batch_qps)
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Paridad y latencia de backends de embeddings frente a torch')
+    parser.add_argument('--backends', nargs='+', choices=EMBEDDING_BACKENDS[1:],
+                        default=list(EMBEDDING_BACKENDS[1:]))
+    parser.add_argument('--kb', default='knowledge_base.json')
+    parser.add_argument('--queries', type=int, default=100,
+                        help='Textos de la base usados para el benchmark de latencia')
+    args = parser.parse_args()
+
+    with open(args.kb, encoding='utf-8') as f:
+        knowledge_data = json.load(f)
+    kb_documents = knowledge_data.get('documents', knowledge_data)
+    kb_texts = [doc['text'] for doc in kb_documents]
+    bench_queries = [text[:200] for text in kb_texts[:args.queries]]
+
+    reference = load_embedding_model('torch')
+    results = {'torch': (None, latency_benchmark(reference, bench_queries))}
+    for name in args.backends:
+        candidate = load_embedding_model(name)
+        results[name] = (parity_check(reference, candidate, kb_texts),
+                         latency_benchmark(candidate, bench_queries))
+
+    print(f"{'backend':<10} {'coseno medio':>12} {'coseno mín':>11} {'p50 ms':>8} {'p95 ms':>8} {'lote q/s':>9}")
+    for name, (parity, latency) in results.items():
+        mean = f"{parity['mean']:.5f}" if parity else '-'
+        low = f"{parity['min']:.5f}" if parity else '-'
+        print(f"{name:<10} {mean:>12} {low:>11} {latency['p50_ms']:>8.2f} "
+              f"{latency['p95_ms']:>8.2f} {latency['batch_qps']:>9.1f}")
@@ -1,11 +1,14 @@
 import os
 import json
 import re
+import hashlib
 import logging
 from pathlib import Path
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from embeddings import EMBEDDING_BACKENDS, MODEL_NAME, load_embedding_model
+from kb_store import write_store
 
 logging.basicConfig(
     level=logging.INFO,
@@ -406,9 +409,184 @@ def extract_standard_fields(body):
     
     return fields
 
+INDEX_METRICS = ('cosine', 'l2')
+INDEX_TYPES = ('auto', 'flat', 'hnsw', 'ivfpq')
+
+# Selección automática por número de documentos: por debajo de
+# HNSW_MIN_DOCS el escaneo plano es más rápido que cualquier ANN
+HNSW_MIN_DOCS = int(os.getenv('HNSW_MIN_DOCS', '10000'))
+IVFPQ_MIN_DOCS = int(os.getenv('IVFPQ_MIN_DOCS', '200000'))
+
+HNSW_M = int(os.getenv('HNSW_M', '32'))
+HNSW_EF_CONSTRUCTION = int(os.getenv('HNSW_EF_CONSTRUCTION', '200'))
+
+
+def select_index_type(n_docs, index_type='auto'):
+    """Resolver 'auto' según el tamaño de la base"""
+    if index_type != 'auto':
+        return index_type
+    if n_docs >= IVFPQ_MIN_DOCS:
+        return 'ivfpq'
+    if n_docs >= HNSW_MIN_DOCS:
+        return 'hnsw'
+    return 'flat'
+
+
+def _pq_subquantizers(dimension):
+    """Mayor número de subcuantizadores <= 48 que divide la dimensión"""
+    for m in range(min(48, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def build_faiss_index(embeddings, metric='cosine', index_type='flat'):
+    """
+    Construir índice FAISS según métrica y tipo
+    
+    Args:
+        embeddings: Matriz (n_docs, dim) float32
+        metric: 'cosine' (vectores normalizados + producto interno) o 'l2'
+        index_type: 'flat', 'hnsw', 'ivfpq' o 'auto'
+        
+    Returns:
+        (índice, metadatos del índice para knowledge_base.json)
+    """
+    if metric not in INDEX_METRICS:
+        raise ValueError(f"Métrica no soportada: {metric}")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Tipo de índice no soportado: {index_type}")
+    
+    embeddings = np.array(embeddings, dtype='float32', order='C')
+    n_docs, dimension = embeddings.shape
+    index_type = select_index_type(n_docs, index_type)
+    
+    if metric == 'cosine':
+        faiss.normalize_L2(embeddings)
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == 'cosine' else faiss.METRIC_L2
+    
+    index_metadata = {
+        'metric': metric,
+        'type': index_type,
+        'normalized': metric == 'cosine'
+    }
+    
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss_metric)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index_metadata.update({'M': HNSW_M, 'efConstruction': HNSW_EF_CONSTRUCTION})
+    
+    elif index_type == 'ivfpq':
+        # nlist ~ 4*sqrt(n), con al menos ~39 puntos de entrenamiento por lista
+        nlist = max(1, min(int(4 * np.sqrt(n_docs)), n_docs // 39))
+        m = _pq_subquantizers(dimension)
+        nbits = max(1, min(8, int(np.log2(max(n_docs // 39, 2)))))
+        
+        if metric == 'cosine':
+            quantizer = faiss.IndexFlatIP(dimension)
+        else:
+            quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, nbits, faiss_metric)
+        index.train(embeddings)
+        index_metadata.update({'nlist': nlist, 'pq_m': m, 'pq_nbits': nbits})
+    
+    else:
+        if metric == 'cosine':
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            index = faiss.IndexFlatL2(dimension)
+    
+    index.add(embeddings)
+    return index, index_metadata
+
+
+def recall_latency_report(embeddings, query_vectors, metric='cosine', k=10,
+                          ef_values=(16, 32, 64, 128, 256),
+                          nprobe_values=(1, 2, 4, 8, 16, 32)):
+    """
+    Comparar HNSW / IVF-PQ contra el índice plano (recall@k y latencia)
+    
+    Las consultas se ejecutan una a una, como en el bot, y la latencia es la
+    media por consulta en milisegundos.
+    
+    Returns:
+        Lista de filas {'index', 'param', 'value', 'recall', 'latency_ms'}
+    """
+    import time
+    
+    query_vectors = np.array(query_vectors, dtype='float32', order='C')
+    if metric == 'cosine':
+        faiss.normalize_L2(query_vectors)
+    k = min(k, len(embeddings))
+    
+    def timed_search(index):
+        start = time.perf_counter()
+        ids = [index.search(q[None, :], k)[1][0] for q in query_vectors]
+        elapsed_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+        return np.array(ids), elapsed_ms
+    
+    def recall(ids):
+        hits = sum(len(set(row[row >= 0]) & set(ref)) for row, ref in zip(ids, flat_ids))
+        return hits / (len(flat_ids) * k)
+    
+    flat, _ = build_faiss_index(embeddings, metric, 'flat')
+    flat_ids, flat_ms = timed_search(flat)
+    rows = [{'index': 'flat', 'param': '-', 'value': '-', 'recall': 1.0, 'latency_ms': flat_ms}]
+    
+    hnsw, _ = build_faiss_index(embeddings, metric, 'hnsw')
+    for ef in ef_values:
+        hnsw.hnsw.efSearch = ef
+        ids, ms = timed_search(hnsw)
+        rows.append({'index': 'hnsw', 'param': 'efSearch', 'value': ef, 'recall': recall(ids), 'latency_ms': ms})
+    
+    ivf, ivf_metadata = build_faiss_index(embeddings, metric, 'ivfpq')
+    for nprobe in nprobe_values:
+        if nprobe > ivf_metadata['nlist']:
+            break
+        ivf.nprobe = nprobe
+        ids, ms = timed_search(ivf)
+        rows.append({'index': 'ivfpq', 'param': 'nprobe', 'value': nprobe, 'recall': recall(ids), 'latency_ms': ms})
+    
+    logger.info("="*60)
+    logger.info(f"RECALL@{k} VS LATENCIA ({len(query_vectors)} consultas, {len(embeddings)} docs)")
+    logger.info("="*60)
+    logger.info(f"   {'índice':<8} {'parámetro':<10} {'valor':>6} {'recall':>8} {'ms/consulta':>12}")
+    for row in rows:
+        logger.info(f"   {row['index']:<8} {row['param']:<10} {str(row['value']):>6} "
+                    f"{row['recall']:>8.3f} {row['latency_ms']:>12.3f}")
+    logger.info("="*60)
+    
+    return rows
+
+
+def report_queries(documents, limit=200):
+    """Consultas de prueba derivadas de la base: preguntas frecuentes y títulos"""
+    queries = []
+    for doc in documents:
+        if doc.get('pregunta'):
+            queries.append(doc['pregunta'])
+        else:
+            queries.append(doc['text'].split('\n', 1)[0])
+    return queries[:limit]
+
+
+def compute_kb_version(documents, model_name, index_metadata):
+    """Hash estable del contenido de la base (cambia si cambian docs, modelo o índice)"""
+    payload = json.dumps(
+        {'documents': documents, 'model_name': model_name, 'index': index_metadata},
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
 def create_knowledge_base(docs_folder='docs', 
                          index_file='faiss_index.bin',
-                         json_file='knowledge_base.json'):
+                         json_file='knowledge_base.json',
+                         kb_file='knowledge_base.kb',
+                         metric='cosine',
+                         index_type='auto',
+                         report=False,
+                         backend='torch'):
     """Crear base de conocimiento FAISS - CORREGIDO"""
     
     logger.info("="*60)
@@ -416,8 +594,8 @@ def create_knowledge_base(docs_folder='docs',
     logger.info("="*60)
     
     # 1. Cargar modelo de embeddings
-    logger.info("Cargando modelo de embeddings...")
-    model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+    logger.info(f"Cargando modelo de embeddings (backend: {backend})...")
+    model = load_embedding_model(backend)
     
     # 2. Leer todos los archivos .md
     docs_path = Path(docs_folder)
@@ -473,21 +651,30 @@ def create_knowledge_base(docs_folder='docs',
     embeddings = model.encode(texts, show_progress_bar=True)
     
     # 5. Crear índice FAISS
-    logger.info("Creando índice FAISS...")
     dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings.astype('float32'))
+    resolved_type = select_index_type(len(all_documents), index_type)
+    logger.info(f"Creando índice FAISS (métrica: {metric}, tipo: {resolved_type})...")
+    index, index_metadata = build_faiss_index(embeddings, metric, resolved_type)
+    # Los vectores de consulta deben venir del mismo backend (ver main.load_embedding_backend)
+    index_metadata['embedding_backend'] = backend
+    
+    if report:
+        query_vectors = model.encode(report_queries(all_documents))
+        recall_latency_report(embeddings, query_vectors, metric)
     
     # 6. Guardar archivos
     logger.info(f"Guardando índice FAISS...")
     faiss.write_index(index, index_file)
     
     logger.info(f"Guardando documentos JSON...")
+    kb_version = compute_kb_version(all_documents, MODEL_NAME, index_metadata)
     knowledge_data = {
         'documents': all_documents,
-        'model_name': 'paraphrase-multilingual-MiniLM-L12-v2',
+        'model_name': MODEL_NAME,
+        'kb_version': kb_version,
         'total_docs': len(all_documents),
         'dimension': dimension,
+        'index': index_metadata,
         'chunk_types': type_counts,
         'faculty_counts': faculty_counts,
         'created_at': str(np.datetime64('now'))
@@ -496,15 +683,42 @@ def create_knowledge_base(docs_folder='docs',
     with open(json_file, 'w', encoding='utf-8') as f:
         json.dump(knowledge_data, f, ensure_ascii=False, indent=2)
     
+    # Formato columnar para main.py (el JSON se mantiene para utils y dashboard)
+    logger.info(f"Guardando base columnar {kb_file}...")
+    write_store(kb_file, all_documents, {k: v for k, v in knowledge_data.items() if k != 'documents'})
+    
     logger.info("="*60)
     logger.info("✅ BASE DE CONOCIMIENTO CREADA EXITOSAMENTE")
     logger.info(f"   Archivos procesados: {len(md_files)}")
     logger.info(f"   Documentos totales: {len(all_documents)}")
     logger.info(f"   Dimensión embeddings: {dimension}")
+    logger.info(f"   Métrica índice: {metric}")
+    logger.info(f"   Tipo índice: {index_metadata['type']}")
+    logger.info(f"   Backend embeddings: {backend}")
+    logger.info(f"   Versión KB: {kb_version}")
     logger.info("="*60)
     
     return True
 
 if __name__ == '__main__':
-    success = create_knowledge_base()
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Crear base de conocimiento FAISS')
+    parser.add_argument('--metric', choices=INDEX_METRICS,
+                        default=os.getenv('INDEX_METRIC', 'cosine'),
+                        help='Métrica del índice (cosine = IndexFlatIP normalizado)')
+    parser.add_argument('--index-type', choices=INDEX_TYPES,
+                        default=os.getenv('INDEX_TYPE', 'auto'),
+                        help='flat, hnsw, ivfpq o auto (según número de documentos)')
+    parser.add_argument('--report', action='store_true',
+                        help='Mostrar recall vs latencia de HNSW/IVF-PQ frente al índice plano')
+    parser.add_argument('--backend', choices=EMBEDDING_BACKENDS,
+                        default=os.getenv('EMBEDDING_BACKEND', 'torch'),
+                        help='Backend de embeddings (el bot debe usar el mismo o uno con paridad)')
+    args = parser.parse_args()
+    
+    success = create_knowledge_base(metric=args.metric,
+                                    index_type=args.index_type,
+                                    report=args.report,
+                                    backend=args.backend)
     exit(0 if success else 1)
\ No newline at end of file
@@ -0,0 +1,227 @@
+"""
+Base de conocimiento en formato binario columnar (knowledge_base.kb)
+ingest.py la genera junto a knowledge_base.json; main.py la abre con
+memory-map y lee cada documento bajo demanda, sin parsear JSON completo.
+
+Estructura del archivo:
+    MAGIC (8 bytes) | largo del encabezado (uint64 LE) | encabezado JSON |
+    arrays alineados a 8 bytes (offsets relativos al inicio de los datos)
+
+Arrays:
+    text_blob / text_offsets    Textos UTF-8 concatenados y sus límites
+    codes                       (n_docs, n_campos) int32: campos de baja
+                                cardinalidad internados (-1 = ausente)
+    extra_blob / extra_offsets  Resto de campos por documento (JSON compacto)
+
+Convertir una base existente:
+    python kb_store.py knowledge_base.json knowledge_base.kb
+"""
+
+import json
+import os
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+MAGIC = b'VRIKB\x00\x01\x00'
+FORMAT_VERSION = 1
+INTERNED_FIELDS = ('type', 'source', 'entidad', 'facultad', 'escuela')
+_ALIGN = 8
+
+
+def _offsets(chunks):
+    offsets = np.zeros(len(chunks) + 1, dtype='<i8')
+    np.cumsum([len(c) for c in chunks], out=offsets[1:])
+    return offsets
+
+
+def encode_store(documents, info=None) -> bytes:
+    """
+    Serializar documentos al formato columnar
+
+    Args:
+        documents: Lista de dicts de ingest.py
+        info: Metadatos de la base (kb_version, model_name, index, ...)
+    """
+    vocab_index = {field: {} for field in INTERNED_FIELDS}
+    codes = np.full((len(documents), len(INTERNED_FIELDS)), -1, dtype='<i4')
+    texts, extras = [], []
+
+    for i, doc in enumerate(documents):
+        extra = {}
+        for key, value in doc.items():
+            if key in vocab_index and isinstance(value, str):
+                codes[i, INTERNED_FIELDS.index(key)] = vocab_index[key].setdefault(value, len(vocab_index[key]))
+            elif key != 'text':
+                extra[key] = value
+        texts.append(doc.get('text', '').encode('utf-8'))
+        extras.append(json.dumps(extra, ensure_ascii=False, separators=(',', ':')).encode('utf-8') if extra else b'')
+
+    arrays = {
+        'codes': codes,
+        'text_offsets': _offsets(texts),
+        'text_blob': np.frombuffer(b''.join(texts), dtype='u1'),
+        'extra_offsets': _offsets(extras),
+        'extra_blob': np.frombuffer(b''.join(extras), dtype='u1'),
+    }
+
+    layout, chunks, position = {}, [], 0
+    for name, array in arrays.items():
+        data = np.ascontiguousarray(array).tobytes()
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        chunks.append(data + b'\0' * (-len(data) % _ALIGN))
+        position += len(chunks[-1])
+
+    header = json.dumps({
+        'format': FORMAT_VERSION,
+        'n_docs': len(documents),
+        'interned_fields': list(INTERNED_FIELDS),
+        'vocab': {field: list(values) for field, values in vocab_index.items()},
+        'arrays': layout,
+        'info': info or {},
+    }, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % _ALIGN)
+
+    return b''.join([MAGIC, len(header).to_bytes(8, 'little'), header, *chunks])
+
+
+def write_store(path, documents, info=None):
+    """Escribir el archivo .kb (reemplazo atómico)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_store(documents, info))
+    os.replace(tmp_path, path)
+
+
+class KBDocument(Mapping):
+    """
+    Vista de solo lectura de un documento de la base
+
+    Se comporta como un dict (get, in, items, dict(doc)); cada campo se lee
+    del archivo al accederlo, así que los valores devueltos son copias
+    nuevas y la vista se puede compartir desde caché. with_scores() añade
+    doc_id/similarity/... sin copiar el documento.
+    """
+
+    __slots__ = ('_store', '_index', '_scores')
+
+    def __init__(self, store, index, scores=None):
+        self._store = store
+        self._index = index
+        self._scores = scores
+
+    def __getitem__(self, key):
+        if self._scores and key in self._scores:
+            return self._scores[key]
+        if key == 'text':
+            return self._store.text(self._index)
+        if key in self._store.field_positions:
+            value = self._store.interned(self._index, key)
+            if value is not None:
+                return value
+        return self._store.extra(self._index)[key]
+
+    def __iter__(self):
+        yield 'text'
+        for field in self._store.interned_fields:
+            if self._store.interned(self._index, field) is not None:
+                yield field
+        yield from self._store.extra(self._index)
+        if self._scores:
+            yield from self._scores
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def with_scores(self, **scores):
+        return KBDocument(self._store, self._index, scores)
+
+    def __repr__(self):
+        return f"KBDocument({dict(self)!r})"
+
+
+class KnowledgeBaseStore(Sequence):
+    """Base de conocimiento columnar; store[i] devuelve un KBDocument"""
+
+    def __init__(self, buffer):
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError("No es un archivo de base de conocimiento (.kb)")
+
+        header_len = int.from_bytes(bytes(buffer[len(MAGIC):len(MAGIC) + 8]), 'little')
+        data_start = len(MAGIC) + 8 + header_len
+        header = json.loads(bytes(buffer[len(MAGIC) + 8:data_start]).decode('utf-8'))
+        if header['format'] != FORMAT_VERSION:
+            raise ValueError(f"Versión de formato no soportada: {header['format']}")
+
+        self._buffer = buffer
+        self.n_docs = header['n_docs']
+        self.info = header['info']
+        self.interned_fields = tuple(header['interned_fields'])
+        self.field_positions = {field: j for j, field in enumerate(self.interned_fields)}
+        self.vocab = header['vocab']
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            start = data_start + spec['offset']
+            size = int(np.prod(spec['shape'], dtype=np.int64)) * dtype.itemsize
+            arrays[name] = buffer[start:start + size].view(dtype).reshape(spec['shape'])
+
+        self._codes = arrays['codes']
+        self._text_offsets = arrays['text_offsets']
+        self._text_blob = arrays['text_blob']
+        self._extra_offsets = arrays['extra_offsets']
+        self._extra_blob = arrays['extra_blob']
+
+    @classmethod
+    def open(cls, path):
+        """Abrir con memory-map (solo se leen del disco las páginas usadas)"""
+        return cls(np.memmap(path, dtype='u1', mode='r'))
+
+    @classmethod
+    def from_documents(cls, documents, info=None):
+        """Misma interfaz en memoria, para bases que solo tienen JSON"""
+        return cls(np.frombuffer(encode_store(documents, info), dtype='u1'))
+
+    def __len__(self):
+        return self.n_docs
+
+    def __getitem__(self, index):
+        index = int(index)
+        if not 0 <= index < self.n_docs:
+            raise IndexError(index)
+        return KBDocument(self, index)
+
+    def text(self, index):
+        start, end = self._text_offsets[index], self._text_offsets[index + 1]
+        return bytes(self._text_blob[start:end]).decode('utf-8')
+
+    def interned(self, index, field):
+        code = self._codes[index, self.field_positions[field]]
+        return self.vocab[field][code] if code >= 0 else None
+
+    def extra(self, index):
+        start, end = self._extra_offsets[index], self._extra_offsets[index + 1]
+        return json.loads(bytes(self._extra_blob[start:end])) if end > start else {}
+
+    def column(self, field):
+        """(códigos int32 por documento, vocabulario) de un campo internado"""
+        return self._codes[:, self.field_positions[field]], self.vocab[field]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convertir knowledge_base.json al formato .kb')
+    parser.add_argument('json_path', nargs='?', default='knowledge_base.json')
+    parser.add_argument('kb_path', nargs='?', default='knowledge_base.kb')
+    args = parser.parse_args()
+
+    with open(args.json_path, encoding='utf-8') as f:
+        knowledge_data = json.load(f)
+    if isinstance(knowledge_data, list):
+        knowledge_data = {'documents': knowledge_data}
+
+    kb_documents = knowledge_data.pop('documents')
+    write_store(args.kb_path, kb_documents, knowledge_data)
+    print(f"{len(kb_documents)} documentos -> {args.kb_path}")
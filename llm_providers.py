@@ -0,0 +1,416 @@
+"""
+Proveedores de LLM (APIs compatibles con OpenAI chat completions)
+Hedging por latencia, failover entre proveedores y circuit breaker
+
+DeepSeek es el proveedor principal; cualquier endpoint compatible
+(p. ej. Ollama en /v1/chat/completions) puede actuar de respaldo.
+"""
+
+import asyncio
+import bisect
+import logging
+import time
+from collections import deque
+from typing import List, Optional
+
+import aiohttp
+import numpy as np
+
+from streaming import iter_sse_content
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """Histograma de latencias (ms) con buckets fijos + ventana reciente para percentiles"""
+
+    BUCKETS_MS = (100, 250, 500, 1000, 2000, 3000, 5000, 8000, 12000, 20000, 30000, 60000)
+
+    def __init__(self, window: int = 200):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.recent = deque(maxlen=window)
+        self.total = 0
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.recent.append(ms)
+        self.total += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        return float(np.percentile(self.recent, q * 100))
+
+    def stats(self) -> dict:
+        labels = [f"<={b}" for b in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}"]
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            'count': self.total,
+            'p50_ms': round(p50, 1) if p50 is not None else None,
+            'p95_ms': round(p95, 1) if p95 is not None else None,
+            'buckets_ms': dict(zip(labels, self.counts))
+        }
+
+
+class CircuitBreaker:
+    """
+    closed -> open tras `failure_threshold` fallos seguidos; open -> half_open
+    pasados `reset_timeout` segundos (se deja pasar una sola petición de prueba
+    a la vez; si no termina en `reset_timeout`, se permite otra)
+
+    allow() solo consulta; acquire() se llama al lanzar la petición.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self._probe_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def _probing(self) -> bool:
+        return self._probe_at is not None and time.monotonic() - self._probe_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        state = self.state
+        return state == 'closed' or (state == 'half_open' and not self._probing())
+
+    def acquire(self) -> bool:
+        """Reservar el paso de una petición (en half_open, la única de prueba)"""
+        if not self.allow():
+            return False
+        if self.state == 'half_open':
+            self._probe_at = time.monotonic()
+        return True
+
+    def release(self):
+        """La petición de prueba se canceló sin resultado"""
+        self._probe_at = None
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_at = None
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+
+
+class ChatProvider:
+    """Un endpoint /chat/completions compatible con OpenAI"""
+
+    def __init__(self, name: str, url: str, model: str, api_key: Optional[str] = None,
+                 timeout: float = 20, breaker: Optional[CircuitBreaker] = None,
+                 stream_usage: bool = False, **params):
+        """
+        Args:
+            stream_usage: Pedir 'usage' al final del stream (stream_options.include_usage);
+                solo para endpoints que lo soportan
+        """
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+        self.stream_usage = stream_usage
+        self.params = params
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyHistogram()
+        self.errors = 0
+
+        # Tokens de prompt servidos desde el caché de contexto del proveedor
+        self.prompt_tokens = 0
+        self.cache_hit_tokens = 0
+        self.cache_miss_tokens = 0
+        self.completion_tokens = 0
+
+    def _request(self, messages, stream=False):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        payload = {"model": self.model, "messages": messages, **self.params}
+        if stream:
+            payload["stream"] = True
+            if self.stream_usage:
+                payload["stream_options"] = {"include_usage": True}
+        return headers, payload
+
+    def record_usage(self, usage):
+        """
+        Acumular el campo 'usage' de la respuesta
+
+        DeepSeek informa prompt_cache_hit_tokens / prompt_cache_miss_tokens;
+        OpenAI y compatibles, prompt_tokens_details.cached_tokens.
+        """
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        hit = usage.get('prompt_cache_hit_tokens')
+        if hit is None:
+            hit = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        miss = usage.get('prompt_cache_miss_tokens', max(prompt_tokens - hit, 0))
+
+        self.prompt_tokens += prompt_tokens
+        self.cache_hit_tokens += hit
+        self.cache_miss_tokens += miss
+        self.completion_tokens += usage.get('completion_tokens') or 0
+        logger.debug(f"🧮 {self.name}: prompt {prompt_tokens} tokens, caché {hit} hit / {miss} miss")
+
+    def _failed(self, reason):
+        self.errors += 1
+        self.breaker.record_failure()
+        logger.error(f"❌ {self.name}: {reason} (circuito {self.breaker.state})")
+
+    async def complete(self, session: aiohttp.ClientSession, messages) -> Optional[str]:
+        """Respuesta completa o None si falló"""
+        start = time.perf_counter()
+        headers, payload = self._request(messages)
+        try:
+            async with session.post(self.url, json=payload, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                if response.status != 200:
+                    self._failed(f"{response.status} - {await response.text()}")
+                    return None
+                data = await response.json()
+                content = (data['choices'][0]['message'].get('content') or '').strip()
+                if data.get('usage'):
+                    self.record_usage(data['usage'])
+        except asyncio.TimeoutError:
+            self._failed(f"timeout ({self.timeout}s)")
+            return None
+        except asyncio.CancelledError:
+            # Perdedor de un hedge: lo transcurrido es una cota inferior de su
+            # latencia. Sin registrarlo el p95 solo vería las rápidas y bajaría.
+            self.latency.observe((time.perf_counter() - start) * 1000)
+            self.breaker.release()
+            raise
+        except Exception as e:
+            # Cualquier otro error (respuesta malformada incluida) cuenta como
+            # fallo: así hay failover y el circuito se entera
+            self._failed(f"{type(e).__name__}: {e}")
+            return None
+
+        if not content:
+            self._failed("respuesta sin contenido")
+            return None
+
+        self.latency.observe((time.perf_counter() - start) * 1000)
+        self.breaker.record_success()
+        return content
+
+    async def stream(self, session: aiohttp.ClientSession, messages, streamer) -> Optional[str]:
+        """
+        Respuesta en streaming entregada a streamer (ParagraphStreamer)
+
+        Returns:
+            Texto completo; el parcial si el stream se corta después de
+            enviar algo (streamer.interrupted); None si no se envió nada.
+        """
+        start = time.perf_counter()
+        headers, payload = self._request(messages, stream=True)
+        try:
+            async with session.post(self.url, json=payload, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                if response.status != 200:
+                    self._failed(f"{response.status} - {await response.text()}")
+                    return None
+                async for delta in iter_sse_content(response, on_usage=self.record_usage):
+                    await streamer.feed(delta)
+            await streamer.finish()
+        except asyncio.TimeoutError:
+            self._failed(f"timeout stream ({self.timeout}s)")
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self._failed(f"{type(e).__name__}: {e}")
+        else:
+            self.latency.observe((time.perf_counter() - start) * 1000)
+            self.breaker.record_success()
+            return streamer.text or None
+
+        if streamer.sent_any:
+            streamer.interrupted = True
+            await streamer.finish()
+            return streamer.text
+        return None
+
+    def stats(self) -> dict:
+        return {
+            'model': self.model,
+            'circuit': self.breaker.state,
+            'times_opened': self.breaker.times_opened,
+            'errors': self.errors,
+            'latency': self.latency.stats(),
+            'tokens': {
+                'prompt': self.prompt_tokens,
+                'completion': self.completion_tokens,
+                'cache_hit': self.cache_hit_tokens,
+                'cache_miss': self.cache_miss_tokens,
+                'cache_hit_ratio': round(self.cache_hit_tokens / self.prompt_tokens, 3) if self.prompt_tokens else None
+            }
+        }
+
+
+class LLMRouter:
+    """
+    Proveedores en orden de preferencia
+
+    - Hedging: si el primero no respondió tras su p95 (acotado por
+      `min_delay`), se lanza una segunda petición al siguiente proveedor
+      (o al mismo si no hay otro); gana la primera respuesta válida y la
+      otra se cancela.
+    - Failover: si una petición falla, se pasa al siguiente proveedor.
+    - Los proveedores con el circuito abierto se saltan.
+    """
+
+    def __init__(self, providers: List[ChatProvider], hedge: bool = True,
+                 hedge_quantile: float = 0.95, min_delay: float = 1.0,
+                 default_delay: float = 4.0, min_samples: int = 20):
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.exhausted = 0
+
+    def hedge_delay(self, provider: ChatProvider) -> float:
+        """Segundos a esperar antes de duplicar la petición"""
+        if len(provider.latency.recent) < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, provider.latency.percentile(self.hedge_quantile) / 1000)
+
+    def _available(self):
+        available = [p for p in self.providers if p.breaker.allow()]
+        if not available:
+            self.exhausted += 1
+            logger.error("❌ Todos los proveedores LLM con circuito abierto")
+        return available
+
+    async def complete(self, session, messages):
+        """
+        Returns:
+            (texto, proveedor) o (None, None) si todos fallaron
+        """
+        self.requests += 1
+        queue = self._available()
+        if not queue:
+            return None, None
+
+        loop = asyncio.get_running_loop()
+        running = {}
+        hedge_task = None
+
+        def launch(*candidates):
+            """Lanzar el primer candidato cuyo circuito acepte la petición"""
+            for provider in candidates:
+                if provider.breaker.acquire():
+                    task = asyncio.create_task(provider.complete(session, messages))
+                    running[task] = provider
+                    return task
+            return None
+
+        def launch_next():
+            while queue:
+                task = launch(queue.pop(0))
+                if task is not None:
+                    return running[task]
+            return None
+
+        primary = launch_next()
+        if primary is None:
+            self.exhausted += 1
+            return None, None
+        hedge_at = loop.time() + self.hedge_delay(primary) if self.hedge else None
+
+        try:
+            while running:
+                timeout = None
+                if hedge_at is not None and hedge_task is None:
+                    timeout = max(0.0, hedge_at - loop.time())
+
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    hedge_task = launch(*queue, primary)
+                    if hedge_task is None:
+                        hedge_at = None
+                        continue
+                    target = running[hedge_task]
+                    if target in queue:
+                        queue.remove(target)
+                    self.hedges += 1
+                    logger.info(f"🪃 Hedge: {primary.name} sin respuesta, lanzando {target.name}")
+                    continue
+
+                for task in done:
+                    provider = running.pop(task)
+                    content = task.result()
+                    if content:
+                        if task is hedge_task:
+                            self.hedge_wins += 1
+                        return content, provider
+
+                # Todas las terminadas fallaron: siguiente proveedor si no queda nada en vuelo
+                if not running and queue:
+                    provider = launch_next()
+                    if provider is not None:
+                        self.failovers += 1
+                        logger.warning(f"🔁 Failover a {provider.name}")
+                    hedge_at = None
+
+            return None, None
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def stream(self, session, messages, streamer):
+        """
+        Streaming con failover (sin hedging: lo ya enviado no se puede deshacer)
+
+        Returns:
+            (texto, proveedor) o (None, None)
+        """
+        self.requests += 1
+        attempts = 0
+        for provider in self._available():
+            if not provider.breaker.acquire():
+                continue
+            attempts += 1
+            if attempts > 1:
+                self.failovers += 1
+                logger.warning(f"🔁 Failover a {provider.name}")
+                # Lo que dejó el intento fallido sin enviar no debe mezclarse
+                streamer.reset()
+            content = await provider.stream(session, messages, streamer)
+            if content or streamer.sent_any:
+                return content, provider
+        return None, None
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'failovers': self.failovers,
+            'exhausted': self.exhausted,
+            'providers': {p.name: p.stats() for p in self.providers}
+        }
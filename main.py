@@ -5,16 +5,25 @@ import asyncio
 from datetime import datetime, timedelta
 import aiohttp
 import asyncpg
+from aiohttp import web
 from dotenv import load_dotenv
-import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from functools import lru_cache
+import hashlib
 import time
-import threading
 import re
 
 from whatsapp_client import WhatsAppAPIClient, extract_phone_number
+from dispatcher import UserDispatcher
+from conversation_store import ConversationWriteBuffer, HistoryCache
+from retrieval_pool import RetrievalExecutor, RetrievalOverloaded
+from embedding_batcher import EmbeddingBatcher
+from embeddings import EMBEDDING_BACKENDS, index_parity, load_embedding_model
+from kb_store import KnowledgeBaseStore
+from streaming import ParagraphStreamer
+from llm_providers import ChatProvider, CircuitBreaker, LLMRouter
+from prompt_builder import PromptBuilder
+from coordinator_directory import CoordinatorDirectory
+from cache import EmbeddingCache, SemanticAnswerCache, TTLCache, freeze, normalize_text
 
 load_dotenv()
 
@@ -30,7 +39,6 @@ MAX_CONCURRENT_MESSAGES = 50
 POLLING_INTERVAL = 3
 MAX_HISTORY_MESSAGES = 3
 INACTIVITY_TIMEOUT = 600
-RATE_LIMIT_DELAY = 0.1
 
 # Cache de conversaciones en memoria
 conversation_cache = {}
@@ -39,6 +47,27 @@ conversation_cache = {}
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
 DEEPSEEK_TIMEOUT = int(os.getenv('DEEPSEEK_TIMEOUT', '20'))
+DEEPSEEK_API_URL = os.getenv('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1/chat/completions')
+# Streaming: enviar la respuesta por párrafos mientras se genera
+DEEPSEEK_STREAM = os.getenv('DEEPSEEK_STREAM', 'false').lower() == 'true'
+STREAM_MIN_CHUNK = int(os.getenv('STREAM_MIN_CHUNK', '300'))
+# Presupuesto del prompt (tokens estimados) y fracción máxima para el historial
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '2000'))
+PROMPT_HISTORY_SHARE = float(os.getenv('PROMPT_HISTORY_SHARE', '0.3'))
+
+# Respaldo compatible con OpenAI (Ollama: http://localhost:11434/v1/chat/completions); vacío = sin respaldo
+LLM_FALLBACK_URL = os.getenv('LLM_FALLBACK_URL', '')
+LLM_FALLBACK_MODEL = os.getenv('LLM_FALLBACK_MODEL', os.getenv('OLLAMA_MODEL', 'deepseek-v3.1:671b-cloud'))
+LLM_FALLBACK_API_KEY = os.getenv('LLM_FALLBACK_API_KEY') or None
+LLM_FALLBACK_TIMEOUT = int(os.getenv('LLM_FALLBACK_TIMEOUT', '30'))
+# Hedging: segunda petición si la primera supera su p95 (mínimo LLM_HEDGE_MIN_DELAY s)
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'true').lower() == 'true'
+LLM_HEDGE_QUANTILE = float(os.getenv('LLM_HEDGE_QUANTILE', '0.95'))
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '1.0'))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv('LLM_HEDGE_DEFAULT_DELAY', '4.0'))
+# Circuit breaker por proveedor
+CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', '5'))
+CIRCUIT_RESET = float(os.getenv('CIRCUIT_RESET', '30'))
 
 WHATSAPP_API_URL = os.getenv('WHATSAPP_API_URL')
 WHATSAPP_API_KEY = os.getenv('WHATSAPP_API_KEY')
@@ -49,18 +78,104 @@ FORMATOS_ENABLED = os.getenv('FORMATOS_ENABLED', 'true').lower() == 'true'
 
 MAX_CONCURRENT = int(os.getenv('MAX_CONCURRENT', '100'))
 POLLING_INTERVAL = int(os.getenv('POLLING_INTERVAL', '2'))
+POLLING_MIN_INTERVAL = float(os.getenv('POLLING_MIN_INTERVAL', '0.5'))
+POLLING_MAX_INTERVAL = float(os.getenv('POLLING_MAX_INTERVAL', str(POLLING_INTERVAL)))
+
+# Recepción de mensajes: 'polling' (consulta al gateway) o 'webhook' (el gateway empuja)
+INTAKE_MODE = os.getenv('INTAKE_MODE', 'polling').lower()
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook/whatsapp')
+WEBHOOK_API_KEY = os.getenv('WEBHOOK_API_KEY') or WHATSAPP_API_KEY
+
+# IDs de mensajes procesados (evita reprocesar y volver a llamar a DeepSeek)
+DEDUP_MAX_SIZE = int(os.getenv('DEDUP_MAX_SIZE', '5000'))
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', '86400'))
+DEDUP_STORE_PATH = os.getenv('DEDUP_STORE_PATH') or None
+
+# Mensajes seguidos del mismo usuario dentro de esta ventana se responden juntos
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0.5'))
+COALESCE_MAX_BATCH = int(os.getenv('COALESCE_MAX_BATCH', '5'))
+
+# Escritura de conversaciones por lotes
+DB_FLUSH_INTERVAL_MS = int(os.getenv('DB_FLUSH_INTERVAL_MS', '200'))
+DB_FLUSH_MAX_ROWS = int(os.getenv('DB_FLUSH_MAX_ROWS', '200'))
+DB_WRITE_QUEUE_SIZE = int(os.getenv('DB_WRITE_QUEUE_SIZE', '5000'))
+HISTORY_CACHE_USERS = int(os.getenv('HISTORY_CACHE_USERS', '10000'))
+
+# Executor dedicado para FAISS + rerank
+RETRIEVAL_WORKERS = int(os.getenv('RETRIEVAL_WORKERS', str(min(4, os.cpu_count() or 1))))
+RETRIEVAL_MAX_QUEUE = int(os.getenv('RETRIEVAL_MAX_QUEUE', '32'))
+
+# Micro-batching de embeddings (0 ms = codificar cada consulta por separado)
+EMBED_BATCH_WINDOW_MS = float(os.getenv('EMBED_BATCH_WINDOW_MS', '5'))
+EMBED_BATCH_MAX = int(os.getenv('EMBED_BATCH_MAX', '64'))
+# Peticiones esperando al modelo antes de descartar (como RETRIEVAL_MAX_QUEUE)
+EMBED_BATCH_MAX_PENDING = int(os.getenv('EMBED_BATCH_MAX_PENDING', '256'))
+
+# Threads intra-op de torch (0 = automático). Con micro-batching el modelo
+# corre solo en el thread del batcher: todos los núcleos. Sin agrupar, los
+# encodes van en paralelo y se reparten los núcleos por worker.
+TORCH_THREADS = int(os.getenv('TORCH_THREADS', '0')) or (
+    (os.cpu_count() or 1) if EMBED_BATCH_WINDOW_MS > 0
+    else max(1, (os.cpu_count() or 1) // RETRIEVAL_WORKERS)
+)
+
+# Backend de embeddings: torch, onnx u onnx-int8 (debe ser compatible con el índice)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch').lower()
+EMBEDDING_PARITY_MIN = float(os.getenv('EMBEDDING_PARITY_MIN', '0.98'))
+
+# Arranque rápido: recibir mensajes antes de cargar el modelo (RAG se activa al terminar)
+FAST_START = os.getenv('FAST_START', 'true').lower() == 'true'
+WARMUP_WAIT = float(os.getenv('WARMUP_WAIT', '10'))
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '8081'))
+
+# Base columnar generada por ingest.py (si falta se usa knowledge_base.json)
+KB_STORE_PATH = os.getenv('KB_STORE_PATH', 'knowledge_base.kb')
 MAX_HISTORY = int(os.getenv('MAX_HISTORY', '5'))
 INACTIVITY_TIMEOUT = int(os.getenv('INACTIVITY_TIMEOUT', '1800'))
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', '2048'))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', '1000'))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', '900'))
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() == 'true'
+SEMANTIC_CACHE_SIZE = int(os.getenv('SEMANTIC_CACHE_SIZE', '500'))
+SEMANTIC_CACHE_TTL = int(os.getenv('SEMANTIC_CACHE_TTL', '3600'))
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv('SEMANTIC_CACHE_MAX_DISTANCE', '0.05'))
+# Contacto de coordinadores (correo/teléfono/horario de <facultad>) desde metadata, sin LLM
+COORDINATOR_FAST_PATH = os.getenv('COORDINATOR_FAST_PATH', 'true').lower() == 'true'
 
 # State
+PROCESS_START = time.monotonic()
+startup_phases = {}
+rag_ready = asyncio.Event()
 db_pool = None
 semaphore = asyncio.Semaphore(MAX_CONCURRENT)
 http_session = None
 embedding_model = None
 faiss_index = None
-documents = []
+documents = KnowledgeBaseStore.from_documents([])
+rerank_engine = None
+index_metric = 'l2'
+kb_version = None
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE)
+result_cache = TTLCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+answer_cache = SemanticAnswerCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_DISTANCE)
 whatsapp_client = None
 event_loop = None
+dispatcher = None
+conversation_writer = ConversationWriteBuffer(
+    flush_interval=DB_FLUSH_INTERVAL_MS / 1000,
+    max_batch=DB_FLUSH_MAX_ROWS,
+    max_queue=DB_WRITE_QUEUE_SIZE
+)
+history_cache = HistoryCache(MAX_HISTORY, HISTORY_CACHE_USERS, INACTIVITY_TIMEOUT)
+retrieval_executor = RetrievalExecutor(RETRIEVAL_WORKERS, RETRIEVAL_MAX_QUEUE, TORCH_THREADS)
+embedding_batcher = EmbeddingBatcher(
+    window_ms=EMBED_BATCH_WINDOW_MS,
+    max_batch=EMBED_BATCH_MAX,
+    max_pending=EMBED_BATCH_MAX_PENDING
+)
+coordinator_directory = CoordinatorDirectory()
 
 # Tracking
 user_last_activity = {}
@@ -102,6 +217,43 @@ FACULTY_EXPANSIONS = {
     'administrativas': ['ciencias administrativas', 'fcah'],
 }
 
+FACULTY_DIRECT_MAPPING = {
+    'enfermería': 'FACULTAD_DE_ENFERMERIA',
+    'enfermeria': 'FACULTAD_DE_ENFERMERIA',
+    'estadística': 'FACULTAD_DE_INGENIERIA_ESTADISTICA_E_INFORMATICA', 
+    'estadistica': 'FACULTAD_DE_INGENIERIA_ESTADISTICA_E_INFORMATICA',
+    'agrarias': 'FACULTAD_DE_CIENCIAS_AGRARIAS',
+    'veterinaria': 'FACULTAD_DE_MEDICINA_VETERINARIA_Y_ZOOTECNIA',
+    'contables': 'FACULTAD_DE_CIENCIAS_CONTABLES_Y_ADMINISTRATIVAS',
+    'económica': 'FACULTAD_DE_INGENIERIA_ECONOMICA',
+    'economica': 'FACULTAD_DE_INGENIERIA_ECONOMICA',
+    'minas': 'FACULTAD_DE_INGENIERIA_DE_MINAS',
+    'derecho': 'FACULTAD_DE_DERECHO_Y_CIENCIAS_POLITICAS',
+    'civil': 'FACULTAD_DE_INGENIERIA_CIVIL',
+    'medicina': 'FACULTAD_DE_MEDICINA_HUMANA'
+}
+
+LINEA_QUERY_WORDS = ['línea', 'linea', 'investigación', 'investigacion', 'sublinea']
+
+# Candidatos por término = top_k * factor. Con coseno el score ya está
+# calibrado y hace falta sobre-pedir menos que con 1/(1+d) sobre L2.
+CANDIDATE_FACTOR = {'cosine': 2, 'l2': 3}
+
+# Umbral del score combinado y escala de los boosts (0.5/0.3/0.1) por métrica.
+# Los de 'l2' son los originales, ajustados sobre 1/(1+d). Los de 'cosine' salen
+# de igualar cuantiles de ambos scores en los pares de documentos de la base
+# (98 docs, paraphrase-multilingual-MiniLM-L12-v2): l2 0.1/0.2/0.3 equivale a
+# coseno 0.46/0.75/0.87, es decir coseno ≈ 2.07·l2 + 0.25. Así el umbral pasa
+# a 0.87 y los boosts se escalan por 2. Recalibrar si cambia el modelo.
+METRIC_SCORING = {
+    'l2': {'threshold': 0.3, 'boost_scale': 1.0},
+    'cosine': {'threshold': 0.87, 'boost_scale': 2.0},
+}
+
+# Parámetros de búsqueda para índices aproximados (ingest.py --index-type)
+HNSW_EF_SEARCH = int(os.getenv('HNSW_EF_SEARCH', '64'))
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', '8'))
+
 # ============================================================================
 # DATABASE ASYNC
 # ============================================================================
@@ -128,49 +280,42 @@ async def init_db_pool_async():
 
 
 async def save_conversation_async(phone, user_msg, bot_msg, model, response_time):
-    """Guardar conversación async - NO BLOQUEANTE"""
+    """Encolar conversación para escritura por lotes - NO BLOQUEANTE salvo cola llena"""
     try:
-        async with db_pool.acquire() as conn:
-            user_id = await conn.fetchval("""
-                INSERT INTO users (phone_number)
-                VALUES ($1)
-                ON CONFLICT (phone_number) 
-                DO UPDATE SET last_seen = CURRENT_TIMESTAMP
-                RETURNING id
-            """, phone)
-            
-            await conn.execute("""
-                INSERT INTO conversations 
-                (user_id, phone_number, user_message, bot_response, 
-                 model_used, response_time_ms, context_length)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-            """, user_id, phone, user_msg, bot_msg, model, response_time, len(user_msg))
-            
+        history_cache.append(phone, user_msg, bot_msg)
+        await conversation_writer.add(phone, user_msg, bot_msg, model, response_time)
     except Exception as e:
         logger.error(f"❌ Error guardando: {e}")
 
 
 async def get_conversation_history_async(phone):
-    """Obtener historial async"""
+    """Obtener historial async (memoria; PostgreSQL solo si no está en caché)"""
     try:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT user_message, bot_response
-                FROM conversations
-                WHERE phone_number = $1
-                ORDER BY created_at DESC
-                LIMIT $2
-            """, phone, MAX_HISTORY)
+        turns = history_cache.get(phone)
+        
+        if turns is None:
+            async with db_pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT user_message, bot_response
+                    FROM conversations
+                    WHERE phone_number = $1
+                    ORDER BY created_at DESC
+                    LIMIT $2
+                """, phone, MAX_HISTORY)
             
-            if not rows:
-                return ""
-            
-            formatted = []
-            for row in reversed(rows):
-                formatted.append(f"Usuario: {row['user_message']}")
-                formatted.append(f"Asistente: {row['bot_response']}")
-            
-            return "\n".join(formatted)
+            turns = history_cache.hydrate(
+                phone, [(row['user_message'], row['bot_response']) for row in reversed(rows)]
+            )
+        
+        if not turns:
+            return ""
+        
+        formatted = []
+        for user_message, bot_response in turns:
+            formatted.append(f"Usuario: {user_message}")
+            formatted.append(f"Asistente: {bot_response}")
+        
+        return "\n".join(formatted)
     except Exception as e:
         logger.error(f"Error historial: {e}")
         return ""
@@ -528,20 +673,209 @@ async def detectar_manual_plataforma(mensaje: str, phone_number: str) -> bool:
 # KNOWLEDGE BASE
 # ============================================================================
 
-def load_knowledge_base(index_path='faiss_index.bin', json_path='knowledge_base.json'):
-    """Cargar base de conocimiento FAISS + documentos JSON"""
-    global embedding_model, faiss_index, documents
-    try:
-        logger.info("Cargando embeddings...")
-        embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+class RerankEngine:
+    """
+    Re-ranking vectorizado sobre los candidatos de FAISS
+    
+    Todo lo que depende solo del documento (facultad, tipo, tokens, clave de
+    deduplicación) se precalcula una vez al cargar la base; por consulta solo
+    se hacen operaciones con arrays sobre el conjunto de candidatos.
+    """
+    
+    def __init__(self, docs, boost_scale=1.0):
+        self.n_docs = len(docs)
+        self.boost_scale = boost_scale
+        
+        facultades = [doc.get('facultad', '').lower() for doc in docs]
+        self.faculty_masks = {
+            target: np.array([target.lower() in f for f in facultades], dtype=bool)
+            for target in set(FACULTY_DIRECT_MAPPING.values())
+        }
+        
+        self.is_linea = np.array(
+            ['linea_investigacion' in doc.get('type', '') for doc in docs], dtype=bool
+        )
         
+        # Índice invertido token -> documentos que lo contienen
+        postings = {}
+        for i, doc in enumerate(docs):
+            for token in set(doc.get('text', '').lower().split()):
+                postings.setdefault(token, []).append(i)
+        self.postings = {token: np.array(ids, dtype=np.int64) for token, ids in postings.items()}
+        
+        # Documentos con el mismo inicio de texto + facultad comparten clave
+        first_seen = {}
+        self.dedup_keys = np.array([
+            first_seen.setdefault(f"{doc.get('text', '')[:100]}_{doc.get('facultad', '')}", i)
+            for i, doc in enumerate(docs)
+        ], dtype=np.int64)
+    
+    def query_boosts(self, query_lower):
+        """Boost de facultad, línea y keywords para todos los documentos"""
+        boosts = np.zeros(self.n_docs, dtype=np.float32)
+        
+        matched = {target for term, target in FACULTY_DIRECT_MAPPING.items() if term in query_lower}
+        if matched:
+            boosts[np.logical_or.reduce([self.faculty_masks[t] for t in matched])] += 0.5 * self.boost_scale
+            logger.info(f"   🎯 MATCH EXACTO: {sorted(matched)}")
+        
+        if any(word in query_lower for word in LINEA_QUERY_WORDS):
+            boosts[self.is_linea] += 0.3 * self.boost_scale
+        
+        for token in set(query_lower.split()):
+            ids = self.postings.get(token)
+            if ids is not None:
+                boosts[ids] += 0.1 * self.boost_scale
+        
+        return boosts
+    
+    def rerank(self, query_lower, similarities, indices, top_k, threshold):
+        """
+        Combinar similitud + boosts, filtrar, deduplicar y ordenar
+        
+        Args:
+            similarities, indices: Matrices (n_términos, k) devueltas por FAISS
+            
+        Returns:
+            (ids, similitudes, scores) de los top_k documentos
+        """
+        flat_ids = indices.ravel()
+        flat_sims = similarities.ravel()
+        valid = (flat_ids >= 0) & (flat_ids < self.n_docs)
+        flat_ids = flat_ids[valid]
+        flat_sims = flat_sims[valid]
+        
+        scores = flat_sims + self.query_boosts(query_lower)[flat_ids]
+        
+        keep = scores >= threshold
+        flat_ids, flat_sims, scores = flat_ids[keep], flat_sims[keep], scores[keep]
+        
+        # Primera aparición de cada documento (orden término -> distancia)
+        _, first = np.unique(self.dedup_keys[flat_ids], return_index=True)
+        first.sort()
+        order = first[np.argsort(-scores[first], kind='stable')][:top_k]
+        
+        return flat_ids[order], flat_sims[order], scores[order]
+
+
+def detect_index_metric(index, knowledge_data):
+    """Métrica del índice: metadatos de ingest.py o, en bases antiguas, el tipo FAISS"""
+    if isinstance(knowledge_data, dict):
+        metric = knowledge_data.get('index', {}).get('metric')
+        if metric:
+            return metric
+    import faiss
+    
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return 'cosine'
+    return 'l2'
+
+
+def configure_index_search(index, knowledge_data):
+    """Aplicar efSearch / nprobe si el índice es aproximado"""
+    index_type = 'flat'
+    if isinstance(knowledge_data, dict):
+        index_type = knowledge_data.get('index', {}).get('type', 'flat')
+    
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return f"{index_type} (efSearch={HNSW_EF_SEARCH})"
+    if hasattr(index, 'nprobe'):
+        index.nprobe = IVF_NPROBE
+        return f"{index_type} (nprobe={IVF_NPROBE})"
+    return index_type
+
+
+def search_index(query_vectors, k):
+    """
+    Buscar en FAISS y devolver similitudes comparables entre consultas
+    
+    Con 'cosine' los vectores se normalizan y el producto interno ya es la
+    similitud; con 'l2' (bases antiguas) se mantiene 1/(1+d).
+    """
+    import faiss
+    
+    query_vectors = np.ascontiguousarray(query_vectors, dtype='float32')
+    if index_metric == 'cosine':
+        faiss.normalize_L2(query_vectors)
+        similarities, indices = faiss_index.search(query_vectors, k)
+        return similarities, indices
+    
+    distances, indices = faiss_index.search(query_vectors, k)
+    return 1 / (1 + distances), indices
+
+
+def read_documents(store_path, json_path):
+    """
+    Documentos de la base como KnowledgeBaseStore
+    
+    Usa el .kb de ingest.py con memory-map; si no existe o es más antiguo
+    que el JSON, convierte el JSON en memoria (misma interfaz).
+    
+    Returns:
+        (store, metadatos de la base, kb_version)
+    """
+    if os.path.exists(store_path) and (
+        not os.path.exists(json_path) or os.path.getmtime(store_path) >= os.path.getmtime(json_path)
+    ):
+        logger.info(f"Cargando documentos desde {store_path} (memory-map)...")
+        store = KnowledgeBaseStore.open(store_path)
+        version = store.info.get('kb_version')
+        if not version:
+            with open(store_path, 'rb') as f:
+                version = hashlib.sha256(f.read()).hexdigest()[:16]
+        return store, store.info, version
+    
+    logger.info(f"Cargando documentos desde {json_path}...")
+    with open(json_path, 'rb') as f:
+        raw = f.read()
+    knowledge_data = json.loads(raw.decode('utf-8'))
+    if isinstance(knowledge_data, list):
+        knowledge_data = {'documents': knowledge_data}
+    
+    info = {k: v for k, v in knowledge_data.items() if k != 'documents'}
+    store = KnowledgeBaseStore.from_documents(knowledge_data['documents'], info)
+    # Bases antiguas sin 'kb_version': hash del archivo
+    return store, info, info.get('kb_version') or hashlib.sha256(raw).hexdigest()[:16]
+
+
+def load_knowledge_base(index_path='faiss_index.bin', json_path='knowledge_base.json',
+                        store_path=KB_STORE_PATH):
+    """Cargar base de conocimiento FAISS + documentos (.kb o JSON)"""
+    global embedding_model, faiss_index, documents, rerank_engine, index_metric, kb_version
+    try:
+        phase_start = time.perf_counter()
         logger.info(f"Cargando índice FAISS desde {index_path}...")
+        import faiss
         faiss_index = faiss.read_index(index_path)
+        startup_phases['kb_index_ms'] = round((time.perf_counter() - phase_start) * 1000)
         
-        logger.info(f"Cargando documentos desde {json_path}...")
-        with open(json_path, 'r', encoding='utf-8') as f:
-            knowledge_data = json.load(f)
-            documents = knowledge_data.get('documents', knowledge_data)
+        phase_start = time.perf_counter()
+        documents, knowledge_data, new_version = read_documents(store_path, json_path)
+        # Disponible antes que el modelo: no necesita embeddings
+        logger.info(f"📇 Coordinadores indexados: {coordinator_directory.load(documents)}")
+        startup_phases['kb_documents_ms'] = round((time.perf_counter() - phase_start) * 1000)
+        
+        phase_start = time.perf_counter()
+        logger.info("Cargando embeddings...")
+        embedding_model, backend = load_embedding_backend(knowledge_data)
+        embedding_batcher.model = embedding_model
+        startup_phases['model_ms'] = round((time.perf_counter() - phase_start) * 1000)
+        logger.info(f"🧠 Backend de embeddings: {backend}")
+        
+        if new_version != kb_version:
+            result_cache.clear()
+            answer_cache.clear()
+        kb_version = new_version
+        logger.info(f"🏷️ Versión KB: {kb_version}")
+        
+        index_metric = detect_index_metric(faiss_index, knowledge_data)
+        logger.info(f"📐 Métrica del índice: {index_metric}")
+        logger.info(f"📐 Tipo de índice: {configure_index_search(faiss_index, knowledge_data)}")
+        
+        scoring = METRIC_SCORING.get(index_metric, METRIC_SCORING['l2'])
+        rerank_engine = RerankEngine(documents, scoring['boost_scale'])
+        logger.info(f"🔍 Umbral similitud: {scoring['threshold']} (boosts x{scoring['boost_scale']})")
         
         type_counts = {}
         for doc in documents:
@@ -557,6 +891,45 @@ def load_knowledge_base(index_path='faiss_index.bin', json_path='knowledge_base.
         return False
 
 
+def load_embedding_backend(knowledge_data):
+    """
+    Modelo de embeddings con EMBEDDING_BACKEND, compatible con el índice
+    
+    Si el índice se construyó con otro backend se comparan sus vectores
+    con los del modelo; por debajo de EMBEDDING_PARITY_MIN se usa el
+    backend del índice hasta reconstruirlo con ingest.py --backend.
+    
+    Returns:
+        (modelo, backend usado)
+    """
+    index_backend = 'torch'
+    if isinstance(knowledge_data, dict):
+        index_backend = knowledge_data.get('index', {}).get('embedding_backend', 'torch')
+    
+    backend = EMBEDDING_BACKEND if EMBEDDING_BACKEND in EMBEDDING_BACKENDS else index_backend
+    try:
+        model = load_embedding_model(backend)
+    except Exception as e:
+        logger.warning(f"⚠️ Backend '{backend}' no disponible ({e}), usando '{index_backend}'")
+        return load_embedding_model(index_backend), index_backend
+    
+    if backend != index_backend:
+        parity = index_parity(model, faiss_index, [doc['text'] for doc in documents])
+        if parity is None:
+            logger.warning(f"⚠️ Índice construido con '{index_backend}' (no verificable). "
+                           f"Reconstruir con: python ingest.py --backend {backend}")
+        elif parity['mean'] < EMBEDDING_PARITY_MIN:
+            logger.error(f"❌ '{backend}' no es compatible con el índice ({index_backend}): "
+                         f"coseno medio {parity['mean']:.4f} < {EMBEDDING_PARITY_MIN}. "
+                         f"Reconstruir con: python ingest.py --backend {backend}")
+            return load_embedding_model(index_backend), index_backend
+        else:
+            logger.info(f"✅ Paridad '{backend}' vs índice ({index_backend}): "
+                        f"coseno medio {parity['mean']:.4f}, mínimo {parity['min']:.4f}")
+    
+    return model, backend
+
+
 def expand_query(query):
     """Expandir términos de búsqueda con sinónimos"""
     expanded_terms = [query.lower()]
@@ -566,103 +939,93 @@ def expand_query(query):
     return ' '.join(expanded_terms)
 
 
-@lru_cache(maxsize=500)
-def search_knowledge_base_cached(query, top_k=5):
-    """Caché de búsquedas optimizadas"""
-    return optimized_search_knowledge_base(query, top_k, similarity_threshold=0.4)
+def search_knowledge_base_cached(query, top_k=5, similarity_threshold=0.3, query_vectors=None):
+    """
+    Caché (TTL + LRU) de búsquedas optimizadas
+    
+    La clave incluye la versión de la KB, así que un redeploy con documentos
+    nuevos invalida las entradas. Devuelve resultados inmutables
+    (tupla de MappingProxyType) que se comparten entre llamadas.
+    """
+    results = lookup_cached_search(query, top_k, similarity_threshold)
+    if results is None:
+        results = run_cached_search(query, top_k, similarity_threshold, query_vectors)
+    return results
+
+
+def lookup_cached_search(query, top_k=5, similarity_threshold=0.3):
+    """Resultados en caché o None (sin tocar el modelo ni FAISS)"""
+    results = result_cache.get((kb_version, normalize_text(query), top_k, similarity_threshold))
+    if results is not None:
+        logger.info(f"⚡ Resultados desde caché: '{query}'")
+    return results
+
+
+def run_cached_search(query, top_k=5, similarity_threshold=0.3, query_vectors=None):
+    """Buscar y guardar en la caché de resultados"""
+    key = (kb_version, normalize_text(query), top_k, similarity_threshold)
+    results = freeze(optimized_search_knowledge_base(query, top_k, similarity_threshold, query_vectors))
+    # No cachear vacíos: pueden venir de un error transitorio
+    if results:
+        result_cache.put(key, results)
+    return results
+
+
+def search_terms(query):
+    """Consulta + expansiones por facultad (una fila de FAISS por término)"""
+    query_lower = query.lower()
+    expanded_terms = [query_lower]
+    
+    for term, facultad_nombre in FACULTY_DIRECT_MAPPING.items():
+        if term in query_lower:
+            expanded_terms.append(facultad_nombre.lower())
+            expanded_terms.append(term)
+    
+    return list(dict.fromkeys(expanded_terms))
 
 
-def optimized_search_knowledge_base(query, top_k=5, similarity_threshold=0.3):
-    """Búsqueda optimizada con mejor matching"""
-    if not embedding_model or not faiss_index:
+def optimized_search_knowledge_base(query, top_k=5, similarity_threshold=0.3, query_vectors=None):
+    """
+    Búsqueda optimizada con mejor matching
+    
+    Args:
+        query_vectors: Embeddings de search_terms(query) ya calculados (p. ej.
+            con el micro-batcher desde el event loop); si faltan se calculan aquí
+    """
+    if not embedding_model or not faiss_index or rerank_engine is None:
         return []
     
     try:
         query_lower = query.lower()
         logger.info(f"🔍 Búsqueda optimizada: '{query}'")
         
-        expanded_terms = [query_lower]
-        
-        FACULTY_DIRECT_MAPPING = {
-            'enfermería': 'FACULTAD_DE_ENFERMERIA',
-            'enfermeria': 'FACULTAD_DE_ENFERMERIA',
-            'estadística': 'FACULTAD_DE_INGENIERIA_ESTADISTICA_E_INFORMATICA', 
-            'estadistica': 'FACULTAD_DE_INGENIERIA_ESTADISTICA_E_INFORMATICA',
-            'agrarias': 'FACULTAD_DE_CIENCIAS_AGRARIAS',
-            'veterinaria': 'FACULTAD_DE_MEDICINA_VETERINARIA_Y_ZOOTECNIA',
-            'contables': 'FACULTAD_DE_CIENCIAS_CONTABLES_Y_ADMINISTRATIVAS',
-            'económica': 'FACULTAD_DE_INGENIERIA_ECONOMICA',
-            'economica': 'FACULTAD_DE_INGENIERIA_ECONOMICA',
-            'minas': 'FACULTAD_DE_INGENIERIA_DE_MINAS',
-            'derecho': 'FACULTAD_DE_DERECHO_Y_CIENCIAS_POLITICAS',
-            'civil': 'FACULTAD_DE_INGENIERIA_CIVIL',
-            'medicina': 'FACULTAD_DE_MEDICINA_HUMANA'
-        }
-        
-        for term, facultad_nombre in FACULTY_DIRECT_MAPPING.items():
-            if term in query_lower:
-                expanded_terms.append(facultad_nombre.lower())
-                expanded_terms.append(term)
+        # Todas las expansiones en un solo encode() y un solo search() multi-fila
+        if query_vectors is None:
+            query_vectors = embedding_cache.encode(embedding_batcher, search_terms(query))
+        logger.debug(f"🧠 Caché embeddings: {embedding_cache.stats()}")
+        similarities, indices = search_index(query_vectors, top_k * CANDIDATE_FACTOR.get(index_metric, 3))
         
-        all_results = []
-        for term in set(expanded_terms):
-            query_vector = embedding_model.encode([term])
-            query_vector = np.array(query_vector).astype('float32')
-            
-            distances, indices = faiss_index.search(query_vector, top_k * 3)
-            similarities = 1 / (1 + distances[0])
-            
-            for i, (similarity, idx) in enumerate(zip(similarities, indices[0])):
-                if idx >= len(documents):
-                    continue
-                    
-                doc = documents[idx].copy()
-                doc['similarity'] = float(similarity)
-                
-                score = similarity
-                doc_text = doc.get('text', '').lower()
-                doc_facultad = doc.get('facultad', '').lower()
-                
-                for search_term, facultad_target in FACULTY_DIRECT_MAPPING.items():
-                    if (search_term in query_lower and 
-                        facultad_target.lower() in doc_facultad):
-                        score += 0.5
-                        logger.info(f"   🎯 MATCH EXACTO: '{search_term}' -> '{facultad_target}'")
-                        break
-                
-                doc_type = doc.get('type', '')
-                if any(word in query_lower for word in ['línea', 'linea', 'investigación', 'investigacion', 'sublinea']):
-                    if 'linea_investigacion' in doc_type:
-                        score += 0.3
-                
-                query_words = set(query_lower.split())
-                doc_words = set(doc_text.split())
-                keyword_matches = len(query_words.intersection(doc_words))
-                score += (keyword_matches * 0.1)
-                
-                doc['combined_score'] = score
-                
-                if score >= similarity_threshold:
-                    all_results.append(doc)
-        
-        unique_results = []
-        seen_doc_ids = set()
-        
-        for result in all_results:
-            doc_id = f"{result.get('text','')[:100]}_{result.get('facultad','')}"
-            if doc_id not in seen_doc_ids:
-                seen_doc_ids.add(doc_id)
-                unique_results.append(result)
+        doc_ids, doc_similarities, doc_scores = rerank_engine.rerank(
+            query_lower, similarities, indices, top_k, similarity_threshold
+        )
         
-        unique_results.sort(key=lambda x: x['combined_score'], reverse=True)
+        # Vistas sobre la base (sin copiar el documento) con los scores
+        results = [
+            documents[idx].with_scores(
+                doc_id=int(idx),
+                similarity=float(similarity),
+                combined_score=float(score)
+            )
+            for idx, similarity, score in zip(doc_ids, doc_similarities, doc_scores)
+        ]
         
-        logger.info(f"📊 Resultados para '{query}': {len(unique_results)} documentos")
-        for i, result in enumerate(unique_results[:3]):
+        logger.info(f"📊 Resultados para '{query}': {len(results)} documentos")
+        for i, result in enumerate(results[:3]):
             logger.info(f"   Top {i+1}: score={result['combined_score']:.3f}, " +
                        f"tipo={result.get('type','?')}, " +
                        f"facultad={result.get('facultad','?')}")
         
-        return unique_results[:top_k]
+        return results
         
     except Exception as e:
         logger.error(f"❌ Error en búsqueda optimizada: {e}")
@@ -689,7 +1052,6 @@ def direct_faculty_search(query, docs, top_k=3):
     for doc in docs:
         doc_facultad = doc.get('facultad', '').lower()
         doc_type = doc.get('type', '')
-        doc_text = doc.get('text', '').lower()
         
         for keyword, faculty_type in faculty_keywords.items():
             if (keyword in query_lower and 
@@ -708,41 +1070,57 @@ def direct_faculty_search(query, docs, top_k=3):
 # DEEPSEEK
 # ============================================================================
 
-async def call_deepseek_async(prompt, timeout=DEEPSEEK_TIMEOUT):
-    """Llamada async a DeepSeek"""
-    try:
-        if not DEEPSEEK_API_KEY:
-            logger.error("❌ DEEPSEEK_API_KEY faltante")
-            return None
-        
-        url = "https://api.deepseek.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "model": DEEPSEEK_MODEL,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.4,
-            "max_tokens": 500,
-            "top_p": 0.8
-        }
+def build_llm_router():
+    """DeepSeek como principal + respaldo compatible con OpenAI (p. ej. Ollama)"""
+    generation = {"temperature": 0.4, "max_tokens": 500, "top_p": 0.8}
+    providers = []
+    
+    if DEEPSEEK_API_KEY:
+        providers.append(ChatProvider(
+            'deepseek', DEEPSEEK_API_URL, DEEPSEEK_MODEL, DEEPSEEK_API_KEY, DEEPSEEK_TIMEOUT,
+            breaker=CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_RESET), stream_usage=True, **generation
+        ))
+    else:
+        logger.error("❌ DEEPSEEK_API_KEY faltante")
+    
+    if LLM_FALLBACK_URL:
+        providers.append(ChatProvider(
+            'fallback', LLM_FALLBACK_URL, LLM_FALLBACK_MODEL, LLM_FALLBACK_API_KEY, LLM_FALLBACK_TIMEOUT,
+            breaker=CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_RESET), **generation
+        ))
+    
+    return LLMRouter(
+        providers,
+        hedge=LLM_HEDGE_ENABLED,
+        hedge_quantile=LLM_HEDGE_QUANTILE,
+        min_delay=LLM_HEDGE_MIN_DELAY,
+        default_delay=LLM_HEDGE_DEFAULT_DELAY
+    )
 
-        async with http_session.post(url, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
-            if response.status == 200:
-                data = await response.json()
-                content = data['choices'][0]['message']['content'].strip()
-                return content
-            else:
-                error_text = await response.text()
-                logger.error(f"DeepSeek error: {response.status} - {error_text}")
-                return None
-    except asyncio.TimeoutError:
-        logger.error(f"Timeout DeepSeek ({timeout}s)")
-        return None
-    except Exception as e:
-        logger.error(f"Error DeepSeek: {e}")
-        return None
+
+llm_router = build_llm_router()
+
+
+async def call_llm_async(messages, streamer=None):
+    """
+    Llamada al LLM con hedging, failover y circuit breaker
+    
+    Args:
+        messages: Mensajes de chat (system fijo + contexto + pregunta)
+    
+    Returns:
+        (texto, modelo que respondió) o (None, None)
+    """
+    if streamer is not None:
+        content, provider = await llm_router.stream(http_session, messages, streamer)
+    else:
+        content, provider = await llm_router.complete(http_session, messages)
+    
+    if not content:
+        return None, None
+    if provider.name != 'deepseek':
+        logger.info(f"🔁 Respuesta de {provider.name} ({provider.model})")
+    return content, provider.model
 
 
 # ============================================================================
@@ -778,17 +1156,32 @@ NO respondas con texto. El sistema ya le enviará automáticamente el archivo PD
 ❌ **NO DIGAS:**
 - "No tengo información específica" (si el contexto tiene datos)
 - "Contacta al Vicerrectorado" (como primera opción)
-- Información genérica sin datos concretos
+- Información genérica sin datos concretos'''
 
-CONTEXTO DISPONIBLE:
-{context}
+# Lo variable va después del system prompt fijo para que el prefijo se reutilice (caché de DeepSeek)
+CONTEXT_TEMPLATE = '''{history}CONTEXTO DISPONIBLE:
+{context}'''
 
-PREGUNTA: {user_query}
+QUESTION_TEMPLATE = '''PREGUNTA: {user_query}
 Proporciona una respuesta COMPLETA con toda la información relevante del contexto:'''
 
+prompt_builder = PromptBuilder(
+    IMPROVED_SYSTEM_PROMPT,
+    CONTEXT_TEMPLATE,
+    QUESTION_TEMPLATE,
+    budget=PROMPT_TOKEN_BUDGET,
+    history_share=PROMPT_HISTORY_SHARE
+)
+
 
-async def generate_response_async(user_message, context_docs=[], history="", is_first_message=False):
-    """Generar respuesta con contexto mejorado"""
+async def generate_response_async(user_message, context_docs=[], history="", is_first_message=False,
+                                  streamer=None):
+    """
+    Generar respuesta con contexto mejorado
+    
+    Con streamer (ParagraphStreamer) la respuesta de DeepSeek se va enviando
+    por párrafos y el texto devuelto es el completo.
+    """
     
     if is_first_message:
         return (
@@ -811,39 +1204,18 @@ async def generate_response_async(user_message, context_docs=[], history="", is_
     if not context_docs:
         return "No encuentro información específica sobre ese tema en mi base de conocimiento actual. Te recomiendo contactar directamente con la coordinación de investigación de la facultad correspondiente.", "no_context"
     
-    context_text = ""
-    if context_docs:
-        context_parts = []
-        for doc in context_docs[:4]:
-            doc_type = doc.get('type', '')
-            doc_facultad = doc.get('facultad', '')
-            
-            header = ""
-            if doc_facultad:
-                header += f"[Facultad: {doc_facultad}]"
-            if doc_type:
-                header += f"[Tipo: {doc_type}]"
-            
-            doc_content = doc.get('text', '')
-            if header:
-                context_parts.append(f"{header}\n{doc_content}")
-            else:
-                context_parts.append(doc_content)
-        
-        context_text = "\n\n---\n\n".join(context_parts)
-        logger.info(f"📄 Contexto construido: {len(context_docs)} docs, {len(context_text)} chars")
-    
-    history_section = f"CONVERSACIÓN PREVIA:\n{history}\n\n" if history else ""
-    
-    full_prompt = IMPROVED_SYSTEM_PROMPT.format(
-        context=context_text,
-        user_query=user_message
+    messages, prompt_report = prompt_builder.build(user_message, context_docs, history)
+    logger.info(
+        f"📄 Prompt: ~{prompt_report['tokens']} tokens | "
+        f"{prompt_report['docs_used']} docs ({prompt_report['docs_dropped']} descartados), "
+        f"contexto {prompt_report['raw_context_tokens']}→{prompt_report['context_tokens']} tokens, "
+        f"{prompt_report['history_turns']} turnos de historial"
     )
     
-    response = await call_deepseek_async(full_prompt)
+    response, model_used = await call_llm_async(messages, streamer)
     
     if response:
-        return response, DEEPSEEK_MODEL
+        return response, model_used
     
     return "Disculpa, tengo dificultades técnicas en este momento. Por favor intenta nuevamente o contacta directamente al Vicerrectorado de Investigación.", "error"
 
@@ -876,12 +1248,12 @@ async def check_inactive_users():
                         "_Para iniciar una nueva conversación, simplemente envía un mensaje._"
                     )
                     
-                    whatsapp_client.send_text(phone, closure_message)
+                    await whatsapp_client.send_text_async(phone, closure_message)
                     user_closed_sessions.add(phone)
                     
-                    asyncio.create_task(save_conversation_async(
+                    await save_conversation_async(
                         phone, "[CIERRE_AUTOMATICO]", closure_message, "system", 0
-                    ))
+                    )
                     
                     logger.info(f"🔒 Sesión cerrada por inactividad: {phone}")
                     
@@ -896,42 +1268,161 @@ async def check_inactive_users():
 # MESSAGE PROCESSING ⭐ ACTUALIZADO CON FORMATOS
 # ============================================================================
 
+async def timed_stage(name, coro, timings):
+    """Ejecutar una etapa del pipeline registrando su duración (ms) en timings"""
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[name] = (time.perf_counter() - start) * 1000
+
+
+async def detect_intent_async(user_message, phone_number):
+    """
+    Intenciones con respuesta propia (manual, formatos de tesis)
+    
+    Returns:
+        True si ya se respondió al usuario y hay que detener el procesamiento
+    """
+    # PRIORIDAD 0: Manual de la plataforma
+    try:
+        if await detectar_manual_plataforma(user_message, phone_number):
+            logger.info(f"📚 Manual enviado - DETENIENDO procesamiento")
+            return True
+    except Exception as e:
+        logger.error(f"❌ Error en manual: {e}")
+        # Si hay error, continuar con el flujo normal
+    
+    # PRIORIDAD 1: Formatos de tesis
+    if FORMATOS_ENABLED:
+        try:
+            es_formato, enviado = await buscar_y_enviar_formato(user_message, phone_number)
+            if es_formato:
+                # Era solicitud de formato (enviado o no)
+                logger.info(f"📄 Formato procesado (enviado={enviado}) - DETENIENDO")
+                return True
+        except Exception as e:
+            logger.error(f"❌ Error en formatos: {e}")
+    
+    return False
+
+
+# Búsqueda descartada por saturación: no es lo mismo que "sin resultados"
+RETRIEVAL_OVERLOADED = object()
+
+
+async def retrieve_documents_async(user_message):
+    """
+    Búsqueda optimizada (executor dedicado) con fallback por facultad
+    
+    Returns:
+        Documentos relevantes; None si el modelo sigue cargando tras WARMUP_WAIT;
+        RETRIEVAL_OVERLOADED si la búsqueda se descartó por saturación y el
+        fallback por palabras clave no encontró nada
+    """
+    if not rag_ready.is_set():
+        try:
+            await asyncio.wait_for(rag_ready.wait(), WARMUP_WAIT)
+        except asyncio.TimeoutError:
+            return None
+    
+    shed = False
+    try:
+        threshold = METRIC_SCORING.get(index_metric, METRIC_SCORING['l2'])['threshold']
+        relevant_docs = lookup_cached_search(user_message, 5, threshold)
+        if relevant_docs is None:
+            # Embeddings desde el event loop: todas las consultas concurrentes
+            # caen en el mismo lote del batcher (no solo RETRIEVAL_WORKERS)
+            try:
+                query_vectors = await embedding_cache.encode_async(embedding_batcher, search_terms(user_message))
+            except RetrievalOverloaded:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error codificando la consulta: {e}")
+                query_vectors = None
+            relevant_docs = await retrieval_executor.run(
+                run_cached_search, user_message, 5, threshold, query_vectors
+            )
+    except RetrievalOverloaded as e:
+        # Saturado: sin búsqueda vectorial, solo el fallback por palabras clave
+        logger.warning(f"🚦 Búsqueda descartada por saturación ({e})")
+        relevant_docs = []
+        shed = True
+    
+    if not relevant_docs and any(word in user_message.lower() for word in 
+                            ['línea', 'linea', 'investigación', 'investigacion', 'sublinea']):
+        logger.info("   🔄 Usando búsqueda directa por facultad...")
+        # Recorre toda la base: fuera del event loop. Executor por defecto y no
+        # retrieval_executor, que puede ser justo el que está saturado
+        relevant_docs = await asyncio.get_running_loop().run_in_executor(
+            None, direct_faculty_search, user_message, documents, 3
+        )
+    
+    if shed and not relevant_docs:
+        return RETRIEVAL_OVERLOADED
+    return relevant_docs
+
+
 async def process_message_async(user_message, phone_number):
-    """Procesar mensaje con búsqueda optimizada y envío de formatos"""
+    """
+    Procesar mensaje con búsqueda optimizada y envío de formatos
+    
+    Las etapas independientes corren en paralelo: detección de intención
+    (manual/formatos), búsqueda en la KB e historial. La latencia previa al
+    LLM es la de la etapa más lenta, no la suma.
+    """
     async with semaphore:
         start_time = time.time()
+        timings = {}
         
-        # ========================================
-        # PRIORIDAD 0: Manual de la plataforma
-        # ========================================
-        try:
-            es_manual = await detectar_manual_plataforma(user_message, phone_number)
-            if es_manual:
-                logger.info(f"📚 Manual enviado - DETENIENDO procesamiento")
-                return ""  # Detener aquí - ya se envió el manual
-        except Exception as e:
-            logger.error(f"❌ Error en manual: {e}")
-            # Si hay error, continuar con el flujo normal
+        text = user_message.strip()
+        text_lower = text.lower()
+        
+        # Comandos, saludos y temas ajenos no necesitan KB ni historial
+        is_command = text_lower == '/reset' or text_lower in ['/ayuda', '/help', '/inicio', '/start']
+        is_greeting = text_lower in ['hola', 'hi', 'hello', 'buenos días', 'buenas tardes', 'buenas noches']
+        # Contacto de un coordinador: respuesta directa desde metadata
+        coordinator_hit = coordinator_directory.match(text) if COORDINATOR_FAST_PATH else None
+        trivial = ['hora', 'fecha', 'clima', 'chiste', 'fútbol', 'matemática', 'programación']
+        is_off_topic = (
+            any(k in text_lower for k in trivial)
+            and not any(w in text_lower for w in ['universidad', 'facultad', 'correo', 'tesis', 'investigación', 'linea'])
+            and coordinator_hit is None
+        )
+        needs_context = not (is_command or is_greeting or is_off_topic or coordinator_hit)
         
         # ========================================
-        # PRIORIDAD 1: Formatos de tesis
+        # Etapas en paralelo
         # ========================================
-        if FORMATOS_ENABLED:
-            try:
-                es_formato, enviado = await buscar_y_enviar_formato(user_message, phone_number)
-                
-                if es_formato:
-                    # Era solicitud de formato (enviado o no)
-                    logger.info(f"📄 Formato procesado (enviado={enviado}) - DETENIENDO")
-                    return ""  # Detener aquí - ya se manejó
-                    
-            except Exception as e:
-                logger.error(f"❌ Error en formatos: {e}")
+        intent_task = asyncio.create_task(
+            timed_stage('intent', detect_intent_async(user_message, phone_number), timings)
+        )
+        speculative = []
+        if needs_context:
+            speculative.append(asyncio.create_task(timed_stage('retrieval', retrieve_documents_async(text), timings)))
+            speculative.append(asyncio.create_task(
+                timed_stage('history', get_conversation_history_async(phone_number), timings)
+            ))
+        
+        try:
+            handled = await intent_task
+            if handled:
+                # Ya se envió el manual o formato: la búsqueda y el historial sobran
+                # (y no deben ocupar la cola del executor ni esperar el warm-up)
+                for task in speculative:
+                    task.cancel()
+                return ""  # Detener aquí - ya se envió el manual o formato
+            results = [handled, *await asyncio.gather(*speculative)]
+        except BaseException:
+            for task in speculative:
+                task.cancel()
+            raise
+        timings['pre_llm'] = (time.time() - start_time) * 1000
         
         # ========================================
         # PRIORIDAD 2: Procesamiento normal
         # ========================================
-        user_message = user_message.strip()
+        user_message = text
         
         user_last_activity[phone_number] = datetime.now()
         
@@ -940,46 +1431,97 @@ async def process_message_async(user_message, phone_number):
             user_closed_sessions.remove(phone_number)
 
         # Comandos especiales
-        if user_message.lower() == '/reset':
+        if text_lower == '/reset':
             user_closed_sessions.discard(phone_number)
             return "✓ Conversación reiniciada. ¿En qué puedo ayudarte?"
 
-        if user_message.lower() in ['/ayuda', '/help', '/inicio', '/start']:
+        if is_command:
             response, _ = await generate_response_async("", [], "", is_first_message=True)
             return response
 
         # Filtrar preguntas fuera de contexto
-        trivial = ['hora', 'fecha', 'clima', 'chiste', 'fútbol', 'matemática', 'programación']
-        if any(k in user_message.lower() for k in trivial):
-            if not any(w in user_message.lower() for w in ['universidad', 'facultad', 'correo', 'tesis', 'investigación', 'linea']):
-                return "Disculpa 😊, mi especialidad es información del Vicerrectorado de Investigación. ¿Puedo ayudarte con contactos, líneas de investigación o procesos de tesis?"
+        if is_off_topic:
+            return "Disculpa 😊, mi especialidad es información del Vicerrectorado de Investigación. ¿Puedo ayudarte con contactos, líneas de investigación o procesos de tesis?"
 
-        if user_message.lower() in ['hola', 'hi', 'hello', 'buenos días', 'buenas tardes', 'buenas noches']:
+        if is_greeting:
             response, model = await generate_response_async("", [], "", is_first_message=True)
-            asyncio.create_task(save_conversation_async(
+            await save_conversation_async(
                 phone_number, user_message, response, model, int((time.time() - start_time) * 1000)
-            ))
+            )
             return response
 
-        # Búsqueda optimizada con fallback
-        loop = asyncio.get_event_loop()
-        relevant_docs = await loop.run_in_executor(
-            None, optimized_search_knowledge_base, user_message, 5, 0.3
-        )
-    
-        if not relevant_docs and any(word in user_message.lower() for word in 
-                                ['línea', 'linea', 'investigación', 'investigacion', 'sublinea']):
-            logger.info("   🔄 Usando búsqueda directa por facultad...")
-            relevant_docs = await loop.run_in_executor(
-                None, direct_faculty_search, user_message, documents, 3
+        if coordinator_hit:
+            response = coordinator_directory.render(*coordinator_hit)
+            response_time_ms = int((time.time() - start_time) * 1000)
+            await save_conversation_async(
+                phone_number, user_message, response, "coordinator_template", response_time_ms
             )
-
-        # Obtener historial
-        history_task = asyncio.create_task(get_conversation_history_async(phone_number))
-        history = await history_task
+            fast_path = coordinator_directory.stats()
+            logger.info(f"⚡ Respuesta directa de coordinador ({coordinator_hit[0]}, "
+                        f"{response_time_ms}ms): {phone_number} | ruta directa: "
+                        f"{fast_path['served']}/{fast_path['messages']} mensajes ({fast_path['share']:.0%})")
+            return response
+        
+        relevant_docs, history = results[1], results[2]
+        
+        if relevant_docs is None:
+            logger.info(f"⏳ Modelo aún cargando, consulta de {phone_number} sin RAG")
+            return ("⏳ Estoy terminando de iniciar. Vuelve a enviar tu consulta en unos segundos, por favor. "
+                    "Mientras tanto puedo enviarte formatos de tesis o el manual de la plataforma.")
+        
+        if relevant_docs is RETRIEVAL_OVERLOADED:
+            logger.info(f"🚦 Consulta de {phone_number} sin respuesta por saturación (no se guarda)")
+            return ("⏳ En este momento estoy atendiendo muchas consultas. "
+                    "Vuelve a enviar tu mensaje en unos segundos, por favor.")
+        
+        # Caché semántica: misma intención + mismos documentos -> sin LLM.
+        # Con historial la respuesta depende de la conversación: no se consulta ni se guarda
+        doc_ids = [doc.get('doc_id') for doc in relevant_docs]
+        use_answer_cache = (SEMANTIC_CACHE_ENABLED and relevant_docs and not history
+                            and all(doc_id is not None for doc_id in doc_ids))
+        cached_answer = None
+        if use_answer_cache:
+            try:
+                # Normalmente ya está en la caché de embeddings (lo calculó la búsqueda)
+                query_vector = (await embedding_cache.encode_async(embedding_batcher, [user_message]))[0]
+                cached_answer = answer_cache.lookup(query_vector, doc_ids, kb_version)
+            except Exception as e:
+                logger.error(f"❌ Error en caché semántica: {e}")
+                use_answer_cache = False
         
         # Generar respuesta
-        response, model_used = await generate_response_async(user_message, relevant_docs, history)
+        if cached_answer:
+            response, model_used = cached_answer, "semantic_cache"
+            logger.info(f"⚡ Respuesta desde caché semántica ({answer_cache.stats()['hit_rate']:.0%} hit rate)")
+        else:
+            streamer = None
+            if DEEPSEEK_STREAM:
+                streamer = ParagraphStreamer(
+                    lambda chunk: whatsapp_client.send_text_async(phone_number, chunk),
+                    max_chars=1600,
+                    min_chunk=STREAM_MIN_CHUNK
+                )
+            response, model_used = await timed_stage(
+                'llm', generate_response_async(user_message, relevant_docs, history, streamer=streamer), timings
+            )
+            stream_cut = streamer is not None and streamer.interrupted
+            if stream_cut:
+                logger.warning(f"✂️ Stream interrumpido: respuesta parcial para {phone_number}, no se cachea")
+            if use_answer_cache and model_used == DEEPSEEK_MODEL and not stream_cut:
+                answer_cache.store(query_vector, doc_ids, response, kb_version)
+            
+            if streamer is not None and streamer.sent_any:
+                # Ya entregada por párrafos: se guarda el texto completo, sin recorte
+                timings['first_chunk'] = streamer.first_chunk_ms
+                response_time_ms = int((time.time() - start_time) * 1000)
+                await save_conversation_async(
+                    phone_number, user_message, response, model_used, response_time_ms
+                )
+                stage_log = " | ".join(f"{name} {ms:.0f}ms" for name, ms in timings.items())
+                logger.info(f"⚡ Respuesta en streaming ({model_used}, {response_time_ms}ms, "
+                            f"{streamer.messages_sent} mensajes, docs: {len(relevant_docs)}): {phone_number}")
+                logger.info(f"   ⏱️ Etapas: {stage_log}")
+                return ""
 
         # Limitar longitud
         if len(response) > 1600:
@@ -987,20 +1529,24 @@ async def process_message_async(user_message, phone_number):
 
         response_time_ms = int((time.time() - start_time) * 1000)
         
-        # Guardar NO bloqueante
-        asyncio.create_task(save_conversation_async(
+        # Guardar NO bloqueante (buffer de escritura por lotes)
+        await save_conversation_async(
             phone_number, user_message, response, model_used, response_time_ms
-        ))
+        )
 
+        stage_log = " | ".join(f"{name} {ms:.0f}ms" for name, ms in timings.items())
         logger.info(f"⚡ Respuesta ({model_used}, {response_time_ms}ms, docs: {len(relevant_docs)}): {phone_number}")
+        logger.info(f"   ⏱️ Etapas: {stage_log}")
+        if retrieval_executor.queued:
+            logger.info(f"   🧮 Executor de búsqueda: {retrieval_executor.stats()}")
         return response
 
 # ============================================================================
 # WHATSAPP HANDLER
 # ============================================================================
 
-def handle_incoming_message_sync(message):
-    """Handler SYNC que WhatsAppAPIClient.start_polling() llama"""
+async def handle_incoming_message(message):
+    """Handler async por mensaje (start_polling_async o webhook)"""
     try:
         logger.info(f"📥 Mensaje recibido: {message}")
         
@@ -1023,17 +1569,12 @@ def handle_incoming_message_sync(message):
             logger.warning(f"⚠️ Mensaje vacío de {phone_number}")
             return
 
-        message_id = message.get('id')  # ✅ Extraer el ID
+        message_id = message.get('id')
         
         logger.info(f"📨 {phone_number}: {user_message[:50]}")
 
-        # Ejecutar tarea async en el event loop
-        future = asyncio.run_coroutine_threadsafe(
-            process_and_send(phone_number, user_message, message_id),  # ✅ Pasar el ID
-            event_loop
-        )
-        
-        time.sleep(RATE_LIMIT_DELAY)
+        # Cola por usuario: en orden, sin bloquear la recepción
+        dispatcher.submit(phone_number, user_message, message_id)
         
     except Exception as e:
         logger.error(f"❌ Error handler: {e}", exc_info=True)
@@ -1075,23 +1616,26 @@ async def send_text_async(self, to: str, message: str) -> bool:
         logger.error(f"❌ Excepción al enviar mensaje async: {str(e)}")
         return False
 
-async def process_and_send(phone_number, user_message, message_id=None):
-    """Procesar y enviar respuesta"""
+async def mark_messages_as_read(message_ids):
+    for message_id in message_ids:
+        await whatsapp_client.mark_message_as_read(message_id)
+
+
+async def process_and_send(phone_number, user_message, message_ids=()):
+    """Procesar y enviar respuesta (message_ids: mensajes agrupados en esta llamada)"""
     try:
         bot_response = await process_message_async(user_message, phone_number)
         
         # Si retorna vacío, ya se manejó el mensaje
         if not bot_response or bot_response.strip() == "":
             logger.info(f"✅ Mensaje ya manejado, no enviar respuesta adicional")
-            if message_id:
-                await whatsapp_client.mark_message_as_read(message_id)
+            await mark_messages_as_read(message_ids)
             return  # ← SALIR aquí
         
         # Solo llegar aquí si hay respuesta para enviar
         success = await whatsapp_client.send_text_async(phone_number, bot_response)
         
-        if message_id:
-            await whatsapp_client.mark_message_as_read(message_id)
+        await mark_messages_as_read(message_ids)
         
         if success:
             logger.info(f"✅ Enviado a {phone_number}")
@@ -1105,8 +1649,60 @@ async def process_and_send(phone_number, user_message, message_id=None):
 # MAIN
 # ============================================================================
 
+async def warm_up_async():
+    """Cargar KB + modelo sin bloquear el event loop y activar RAG al terminar"""
+    warm_start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    
+    if not await loop.run_in_executor(None, load_knowledge_base):
+        logger.error("❌ KB falló")
+        return False
+    retrieval_executor.configure_torch()
+    
+    # Primera pasada del modelo: inicializa kernels / sesión ONNX fuera de una consulta real
+    phase_start = time.perf_counter()
+    try:
+        await embedding_batcher.encode_async(["calentamiento del modelo"])
+    except Exception as e:
+        logger.error(f"❌ Calentamiento del modelo falló: {e}")
+        return False
+    startup_phases['warmup_encode_ms'] = round((time.perf_counter() - phase_start) * 1000)
+    startup_phases['warmup_total_ms'] = round((time.perf_counter() - warm_start) * 1000)
+    startup_phases['rag_ready_ms'] = round((time.monotonic() - PROCESS_START) * 1000)
+    
+    rag_ready.set()
+    logger.info(f"🧠 RAG listo: {startup_phases}")
+    return True
+
+
+async def start_health_server():
+    """GET /health: estado del arranque (warming/ready), fases y colas"""
+    async def health(request):
+        return web.json_response({
+            'status': 'ready' if rag_ready.is_set() else 'warming',
+            'uptime_s': round(time.monotonic() - PROCESS_START, 1),
+            'startup_phases': startup_phases,
+            'kb_version': kb_version,
+            'dispatcher': dispatcher.stats() if dispatcher else None,
+            'retrieval': retrieval_executor.stats(),
+            'embedding_batcher': embedding_batcher.stats(),
+            'conversation_writer': conversation_writer.stats(),
+            'coordinator_fast_path': coordinator_directory.stats(),
+            'processed_messages': whatsapp_client.processed_messages.stats() if whatsapp_client else None,
+            'llm': llm_router.stats()
+        })
+    
+    app = web.Application()
+    app.router.add_get('/health', health)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, HEALTH_PORT).start()
+    logger.info(f"🩺 Health en http://{WEBHOOK_HOST}:{HEALTH_PORT}/health")
+    return runner
+
+
 async def main():
-    global http_session, whatsapp_client, event_loop
+    global http_session, whatsapp_client, event_loop, dispatcher
     
     logger.info("=" * 60)
     logger.info("CHATBOT UNA PUNO - VERSIÓN CON ENVÍO DE PDFs")
@@ -1124,49 +1720,94 @@ async def main():
 
     http_session = aiohttp.ClientSession()
 
+    health_runner = await start_health_server() if HEALTH_PORT else None
+
+    phase_start = time.perf_counter()
     logger.info("📊 PostgreSQL async...")
     if not await init_db_pool_async():
         logger.error("❌ PostgreSQL falló")
         return
+    conversation_writer.start(db_pool)
+    retrieval_executor.start()
+    startup_phases['db_ms'] = round((time.perf_counter() - phase_start) * 1000)
 
-    if not load_knowledge_base():
-        logger.error("❌ KB falló")
+    # El modelo carga en segundo plano; sin FAST_START se espera antes de recibir
+    warm_task = asyncio.create_task(warm_up_async())
+    if not FAST_START and not await warm_task:
         return
 
+    phase_start = time.perf_counter()
     logger.info("📱 WhatsApp API...")
-    whatsapp_client = WhatsAppAPIClient(WHATSAPP_API_URL, WHATSAPP_API_KEY)
+    whatsapp_client = WhatsAppAPIClient(
+        WHATSAPP_API_URL, WHATSAPP_API_KEY,
+        dedup_max_size=DEDUP_MAX_SIZE,
+        dedup_ttl=DEDUP_TTL,
+        dedup_path=DEDUP_STORE_PATH
+    )
     
     if not whatsapp_client.check_connection():
         logger.error("❌ WhatsApp falló")
         return
+    startup_phases['whatsapp_ms'] = round((time.perf_counter() - phase_start) * 1000)
 
     logger.info("✅ Todo listo")
     logger.info(f"🚀 Concurrencia máxima: {MAX_CONCURRENT}")
     logger.info(f"⏱️ Timeout inactividad: {INACTIVITY_TIMEOUT}s")
     logger.info(f"🤖 Modelo: {DEEPSEEK_MODEL} (temp: 0.4)")
-    logger.info(f"🔍 Umbral similitud: 0.3")
     logger.info("=" * 60)
 
     # Iniciar task de verificación de inactividad
     asyncio.create_task(check_inactive_users())
 
-    # Usar start_polling en un thread separado
-    def run_polling():
-        whatsapp_client.start_polling(handle_incoming_message_sync, interval=POLLING_INTERVAL)
-    
-    polling_thread = threading.Thread(target=run_polling, daemon=True)
-    polling_thread.start()
-    
-    logger.info("🔄 Polling iniciado en thread separado")
+    dispatcher = UserDispatcher(
+        process_and_send,
+        workers=MAX_CONCURRENT,
+        coalesce_window=COALESCE_WINDOW,
+        max_batch=COALESCE_MAX_BATCH
+    )
+    dispatcher.start()
+
+    webhook_runner = None
+    if INTAKE_MODE == 'webhook':
+        webhook_runner = await whatsapp_client.start_webhook(
+            handle_incoming_message,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            api_key=WEBHOOK_API_KEY
+        )
+        intake_task = asyncio.create_task(asyncio.Event().wait())
+    else:
+        # Polling async en el mismo event loop (intervalo adaptativo)
+        intake_task = asyncio.create_task(whatsapp_client.start_polling_async(
+            handle_incoming_message,
+            min_interval=POLLING_MIN_INTERVAL,
+            max_interval=POLLING_MAX_INTERVAL
+        ))
+        logger.info("🔄 Polling async iniciado")
+
+    startup_phases['accepting_ms'] = round((time.monotonic() - PROCESS_START) * 1000)
+    logger.info(f"🚦 Recibiendo mensajes a los {startup_phases['accepting_ms']}ms "
+                f"({'RAG listo' if rag_ready.is_set() else 'modelo cargando en segundo plano'})")
+
+    # Si la carga en segundo plano falla, detener el bot como antes
+    warm_task.add_done_callback(lambda task: None if task.result() else intake_task.cancel())
 
     try:
-        # Mantener el loop corriendo
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
+        await intake_task
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("\n👋 Deteniendo...")
     finally:
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        if health_runner:
+            await health_runner.cleanup()
+        await dispatcher.stop()
+        await conversation_writer.stop()
+        retrieval_executor.shutdown()
+        embedding_batcher.close()
         await http_session.close()
+        await whatsapp_client.close()
         if db_pool:
             await db_pool.close()
 
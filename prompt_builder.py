@@ -0,0 +1,171 @@
+"""
+Armado del prompt con presupuesto de tokens
+Compacta los documentos, incluye el historial y recorta lo menos relevante
+
+Los mensajes salen con un prefijo estable: primero el system prompt (idéntico
+en todas las peticiones, aprovechable por el caché de contexto del proveedor),
+luego historial + contexto y al final la pregunta.
+"""
+
+import math
+import re
+
+from cache import normalize_text
+
+# DeepSeek: ~0.3 tokens por carácter en idiomas latinos (estimación de su documentación)
+TOKENS_PER_CHAR = 0.3
+
+# Pares "CAMPO: valor" en una sola línea (sección INFORMACIÓN COMPLETA de ingest.py)
+_INLINE_FIELD = re.compile(r'([A-ZÁÉÍÓÚÑ_]{3,}):\s*(.*?)(?=\s+[A-ZÁÉÍÓÚÑ_]{3,}:|$)')
+_FULL_INFO_MARKER = 'INFORMACIÓN COMPLETA:'
+# Campos internos que no aportan al LLM
+_SKIP_FIELDS = {'TIPO'}
+
+
+def estimate_tokens(text: str, tokens_per_char: float = TOKENS_PER_CHAR) -> int:
+    """Estimación de tokens sin tokenizador (suficiente para presupuestar)"""
+    return math.ceil(len(text) * tokens_per_char)
+
+
+def compress_document(text: str) -> str:
+    """
+    Quitar lo redundante de un documento
+
+    - La sección INFORMACIÓN COMPLETA repite en una línea los campos que el
+      documento ya lista; solo se conservan los valores que no aparecen antes.
+    - Líneas repetidas y líneas en blanco múltiples.
+    """
+    head, marker, tail = text.partition(_FULL_INFO_MARKER)
+    lines = []
+    if marker:
+        known = normalize_text(head)
+        extra = [
+            f"{field}: {value.strip()}"
+            for field, value in _INLINE_FIELD.findall(tail.strip())
+            if field not in _SKIP_FIELDS and value.strip() and normalize_text(value) not in known
+        ]
+        text = head.rstrip() + ("\n" + "\n".join(extra) if extra else "")
+
+    seen = set()
+    for line in text.splitlines():
+        key = line.strip()
+        if not key:
+            if lines and lines[-1]:
+                lines.append("")
+            continue
+        if key in seen:
+            continue
+        seen.add(key)
+        lines.append(line.rstrip())
+    return "\n".join(lines).strip()
+
+
+def _clip(text: str, max_tokens: int, tokens_per_char: float) -> str:
+    max_chars = int(max_tokens / tokens_per_char)
+    if len(text) <= max_chars:
+        return text
+    return text[:max(max_chars - 3, 0)].rstrip() + "..."
+
+
+def _history_turns(history: str):
+    """Separar el historial formateado en turnos (cada uno empieza en 'Usuario: ')"""
+    turns = re.split(r'\n(?=Usuario: )', history.strip())
+    return [turn for turn in turns if turn.strip()]
+
+
+class PromptBuilder:
+    """
+    Mensajes = system prompt + historial/contexto + pregunta, dentro de `budget` tokens
+
+    El historial usa como máximo `history_share` del espacio libre (turnos
+    más recientes primero). Los documentos llegan ordenados por relevancia
+    (combined_score) y se descartan desde el menos relevante; el primero se
+    recorta si por sí solo no cabe.
+    """
+
+    def __init__(self, system_prompt: str, context_template: str, question_template: str,
+                 budget: int = 2000, history_share: float = 0.3,
+                 max_docs: int = 4, tokens_per_char: float = TOKENS_PER_CHAR):
+        self.system_prompt = system_prompt
+        self.context_template = context_template
+        self.question_template = question_template
+        self.budget = budget
+        self.history_share = history_share
+        self.max_docs = max_docs
+        self.tokens_per_char = tokens_per_char
+
+    def _tokens(self, text):
+        return estimate_tokens(text, self.tokens_per_char)
+
+    @staticmethod
+    def format_document(doc) -> str:
+        text = compress_document(doc.get('text', ''))
+        header = ""
+        facultad = doc.get('facultad', '')
+        if facultad and facultad not in text:
+            header += f"[Facultad: {facultad}]"
+        if doc.get('type'):
+            header += f"[Tipo: {doc['type']}]"
+        return f"{header}\n{text}" if header else text
+
+    def build_history(self, history: str, max_tokens: int) -> str:
+        if not history or max_tokens <= 0:
+            return ""
+        kept, used = [], 0
+        for turn in reversed(_history_turns(history)):
+            cost = self._tokens(turn) + 1
+            if used + cost > max_tokens:
+                if not kept:
+                    kept.append(_clip(turn, max_tokens, self.tokens_per_char))
+                break
+            kept.append(turn)
+            used += cost
+        return "\n".join(reversed(kept))
+
+    def build(self, user_query: str, docs, history: str = ""):
+        """
+        Returns:
+            (mensajes [system, user contexto, user pregunta], informe {'tokens',
+             'docs_used', 'docs_dropped', 'history_turns', 'raw_context_tokens',
+             'context_tokens'})
+        """
+        question = self.question_template.format(user_query=user_query)
+        base_tokens = self._tokens(
+            self.system_prompt + self.context_template.format(context="", history="") + question
+        )
+        free = max(self.budget - base_tokens, 0)
+
+        history_text = self.build_history(history, int(free * self.history_share))
+        history_section = f"CONVERSACIÓN PREVIA:\n{history_text}\n\n" if history_text else ""
+        free -= self._tokens(history_section)
+
+        separator = "\n\n---\n\n"
+        candidates = docs[:self.max_docs]
+        raw_tokens = sum(self._tokens(doc.get('text', '')) for doc in candidates)
+        parts, used = [], 0
+        for doc in candidates:
+            part = self.format_document(doc)
+            cost = self._tokens(part) + (self._tokens(separator) if parts else 0)
+            if used + cost > free:
+                if not parts:
+                    parts.append(_clip(part, free, self.tokens_per_char))
+                    used = free
+                # El resto tiene menor score: se descarta
+                break
+            parts.append(part)
+            used += cost
+
+        context = separator.join(parts)
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": self.context_template.format(context=context, history=history_section)},
+            {"role": "user", "content": question}
+        ]
+        return messages, {
+            'tokens': sum(self._tokens(m['content']) for m in messages),
+            'docs_used': len(parts),
+            'docs_dropped': len(docs) - len(parts),
+            'history_turns': len(_history_turns(history_text)) if history_text else 0,
+            'raw_context_tokens': raw_tokens,
+            'context_tokens': self._tokens(context)
+        }
@@ -0,0 +1,119 @@
+"""
+Executor dedicado para trabajo CPU (FAISS + rerank; los embeddings van por el micro-batcher)
+Tamaño fijo, cola acotada y descarte de carga cuando se satura
+"""
+
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RetrievalOverloaded(RuntimeError):
+    """La cola del executor superó su límite: la tarea se descartó"""
+
+
+class RetrievalExecutor:
+    """
+    Pool de threads exclusivo para búsqueda
+
+    Con `workers` threads y hasta `max_queue` tareas esperando; por encima
+    de eso run() lanza RetrievalOverloaded en lugar de encolar, para que la
+    latencia de cola se mantenga acotada en ráfagas.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 32, torch_threads: int = 0):
+        """
+        Args:
+            workers: Threads del pool
+            max_queue: Tareas en espera antes de descartar
+            torch_threads: Threads intra-op de torch (0 = núcleos / workers; main.py
+                pasa todos los núcleos cuando el modelo corre solo en el micro-batcher)
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // workers)
+        self._pool = None
+
+        self.inflight = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_wait_ms = 0.0
+        self._total_wait_ms = 0.0
+
+    def start(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='retrieval')
+        logger.info(f"🧮 Executor de búsqueda: {self.workers} workers, cola máx {self.max_queue}")
+
+    def configure_torch(self):
+        """
+        Evitar que cada worker lance todos los núcleos en paralelo
+
+        Se llama después de cargar el modelo, para no importar torch al arrancar.
+        """
+        try:
+            import torch
+            torch.set_num_threads(self.torch_threads)
+            logger.info(f"🧮 torch: {self.torch_threads} threads intra-op")
+        except ImportError:
+            pass
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.inflight - self.workers)
+
+    async def run(self, func, *args):
+        """Ejecutar func(*args) en el pool (RetrievalOverloaded si está saturado)"""
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise RetrievalOverloaded(f"{self.queued} tareas en cola")
+
+        submitted = time.perf_counter()
+
+        def call():
+            wait_ms = (time.perf_counter() - submitted) * 1000
+            self._total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            return func(*args)
+
+        loop = asyncio.get_running_loop()
+        future = self._pool.submit(call)
+        self.inflight += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        # Se descuenta cuando el worker termina, no cuando se cancela quien espera:
+        # una tarea cancelada que sigue corriendo aún ocupa un worker
+        future.add_done_callback(lambda f: self._notify_finished(loop, f))
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def _notify_finished(self, loop, future):
+        """Desde el worker: actualizar contadores en el event loop"""
+        try:
+            loop.call_soon_threadsafe(self._finished, future)
+        except RuntimeError:
+            pass  # Loop ya cerrado (apagado)
+
+    def _finished(self, future):
+        self.inflight -= 1
+        if not future.cancelled():
+            self.completed += 1
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'inflight': self.inflight,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_wait_ms': round(self._total_wait_ms / self.completed, 1) if self.completed else 0.0,
+            'max_wait_ms': round(self.max_wait_ms, 1)
+        }
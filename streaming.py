@@ -0,0 +1,122 @@
+"""
+Streaming de respuestas del LLM hacia WhatsApp
+Lectura de eventos SSE (OpenAI/DeepSeek, stream: true) y envío por párrafos
+"""
+
+import json
+import logging
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+async def iter_sse_content(response, on_usage=None):
+    """
+    Fragmentos de texto de una respuesta SSE de chat completions
+
+    Cada evento es una línea 'data: {...}' con choices[0].delta.content;
+    el stream termina con 'data: [DONE]'. Con stream_options.include_usage
+    el último evento trae 'usage' (sin choices), que se pasa a on_usage.
+    """
+    async for raw_line in response.content:
+        line = raw_line.decode('utf-8').strip()
+        if not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return
+        try:
+            event = json.loads(data)
+            if event.get('usage') and on_usage is not None:
+                on_usage(event['usage'])
+            if not event.get('choices'):
+                continue
+            delta = event['choices'][0].get('delta') or {}
+        except (ValueError, KeyError, IndexError, AttributeError) as e:
+            logger.warning(f"⚠️ Evento SSE inválido ignorado: {e}")
+            continue
+        content = delta.get('content')
+        if content:
+            yield content
+
+
+class ParagraphStreamer:
+    """
+    Acumula el texto generado y envía párrafos completos a medida que terminan
+
+    El primer párrafo sale apenas se completa; los siguientes se agrupan
+    hasta `min_chunk` caracteres para no fragmentar la respuesta en decenas
+    de mensajes. El total enviado respeta `max_chars` (como el recorte de
+    process_message_async) y el texto completo queda en `text`.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable[bool]],
+                 max_chars: int = 1600, min_chunk: int = 300):
+        self.send = send
+        self.max_chars = max_chars
+        self.min_chunk = min_chunk
+
+        self.text = ""
+        self._buffer = ""
+        self._pending = []
+        self.sent_chars = 0
+        self.messages_sent = 0
+        self.truncated = False
+        # El proveedor cortó el stream después de enviar algo: respuesta incompleta
+        self.interrupted = False
+        self.started_at = time.perf_counter()
+        self.first_chunk_ms = None
+
+    @property
+    def sent_any(self) -> bool:
+        return self.messages_sent > 0
+
+    def reset(self):
+        """Descartar lo generado sin enviar (reintento con otro proveedor)"""
+        if self.sent_any:
+            raise RuntimeError("No se puede reiniciar un stream ya enviado")
+        self.text = ""
+        self._buffer = ""
+        self._pending = []
+        self.truncated = False
+        self.interrupted = False
+
+    async def feed(self, delta: str):
+        self.text += delta
+        self._buffer += delta
+
+        while '\n\n' in self._buffer:
+            paragraph, self._buffer = self._buffer.split('\n\n', 1)
+            if paragraph.strip():
+                self._pending.append(paragraph.strip())
+
+        if self._pending and (not self.sent_any or len("\n\n".join(self._pending)) >= self.min_chunk):
+            await self._flush()
+
+    async def finish(self):
+        """Enviar lo que quede (último párrafo sin línea en blanco final)"""
+        if self._buffer.strip():
+            self._pending.append(self._buffer.strip())
+        self._buffer = ""
+        if self._pending:
+            await self._flush()
+        self.text = self.text.strip()
+
+    async def _flush(self):
+        chunk = "\n\n".join(self._pending)
+        self._pending = []
+
+        remaining = self.max_chars - self.sent_chars
+        if self.truncated or remaining <= 0:
+            self.truncated = True
+            return
+        if len(chunk) > remaining:
+            chunk = chunk[:max(remaining - 3, 0)] + "..."
+            self.truncated = True
+
+        if await self.send(chunk):
+            self.sent_chars += len(chunk)
+            self.messages_sent += 1
+            if self.first_chunk_ms is None:
+                self.first_chunk_ms = (time.perf_counter() - self.started_at) * 1000
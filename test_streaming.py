@@ -0,0 +1,133 @@
+"""
+Tests del streaming de respuestas contra un servidor SSE local (falso)
+Stream completo, corte a mitad de respuesta y failover entre proveedores
+(también con respuestas malformadas sin streaming)
+"""
+
+import asyncio
+import json
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from llm_providers import ChatProvider, LLMRouter
+from streaming import ParagraphStreamer
+
+
+def sse_event(content):
+    return f"data: {json.dumps({'choices': [{'delta': {'content': content}}]})}\n\n".encode()
+
+
+async def complete_stream(request):
+    response = web.StreamResponse()
+    await response.prepare(request)
+    for delta in ["Primer ", "párrafo.\n\n", "Segundo ", "párrafo."]:
+        await response.write(sse_event(delta))
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+async def broken_before_paragraph(request):
+    """Se corta antes de completar el primer párrafo (no se envía nada)"""
+    response = web.StreamResponse()
+    await response.prepare(request)
+    await response.write(sse_event("PARCIAL DEL PRINCIPAL "))
+    request.transport.close()
+    return response
+
+
+async def broken_after_paragraph(request):
+    """Se corta después de enviar el primer párrafo"""
+    response = web.StreamResponse()
+    await response.prepare(request)
+    await response.write(sse_event("Primer párrafo.\n\nSegundo a medias"))
+    await asyncio.sleep(0.05)
+    request.transport.close()
+    return response
+
+
+async def run_stream(*paths):
+    """Stream por LLMRouter con un proveedor por ruta; devuelve (texto, proveedor, enviados, streamer)"""
+    app = web.Application()
+    app.router.add_post('/ok', complete_stream)
+    app.router.add_post('/cut-early', broken_before_paragraph)
+    app.router.add_post('/cut-late', broken_after_paragraph)
+
+    server = TestServer(app)
+    await server.start_server()
+    sent = []
+
+    async def send(chunk):
+        sent.append(chunk)
+        return True
+
+    try:
+        router = LLMRouter([
+            ChatProvider(f"p{i}", str(server.make_url(path)), 'fake', timeout=5)
+            for i, path in enumerate(paths)
+        ])
+        streamer = ParagraphStreamer(send, min_chunk=1)
+        async with aiohttp.ClientSession() as session:
+            content, provider = await router.stream(session, [{"role": "user", "content": "hola"}], streamer)
+    finally:
+        await server.close()
+
+    return content, provider, sent, streamer
+
+
+def test_stream_complete():
+    content, provider, sent, streamer = asyncio.run(run_stream('/ok'))
+    assert provider.name == 'p0'
+    assert sent == ["Primer párrafo.", "Segundo párrafo."]
+    assert content == "Primer párrafo.\n\nSegundo párrafo."
+    assert not streamer.interrupted
+
+
+def test_stream_failover_discards_partial_text():
+    content, provider, sent, streamer = asyncio.run(run_stream('/cut-early', '/ok'))
+    assert provider.name == 'p1'
+    assert "PARCIAL" not in content
+    assert not any("PARCIAL" in chunk for chunk in sent)
+    assert content == "Primer párrafo.\n\nSegundo párrafo."
+    assert not streamer.interrupted
+
+
+def test_stream_cut_after_first_paragraph_is_marked_interrupted():
+    content, provider, sent, streamer = asyncio.run(run_stream('/cut-late', '/ok'))
+    # Lo ya enviado no se puede deshacer: sin failover, respuesta parcial marcada
+    assert provider.name == 'p0'
+    assert sent[0] == "Primer párrafo."
+    assert content.startswith("Primer párrafo.")
+    assert streamer.interrupted
+
+
+async def null_content(request):
+    return web.json_response({'choices': [{'message': {'content': None}}]})
+
+
+async def complete_ok(request):
+    return web.json_response({'choices': [{'message': {'content': 'Respuesta del respaldo'}}]})
+
+
+def test_complete_malformed_response_fails_over():
+    async def run():
+        app = web.Application()
+        app.router.add_post('/null', null_content)
+        app.router.add_post('/ok', complete_ok)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            primary = ChatProvider('p0', str(server.make_url('/null')), 'fake', timeout=5)
+            fallback = ChatProvider('p1', str(server.make_url('/ok')), 'fake', timeout=5)
+            router = LLMRouter([primary, fallback], hedge=False)
+            async with aiohttp.ClientSession() as session:
+                content, provider = await router.complete(session, [{"role": "user", "content": "hola"}])
+        finally:
+            await server.close()
+        return content, provider, primary
+
+    content, provider, primary = asyncio.run(run())
+    assert content == 'Respuesta del respaldo'
+    assert provider.name == 'p1'
+    assert primary.errors == 1 and primary.breaker.failures == 1
@@ -0,0 +1,123 @@
+"""
+Tests del webhook y del polling async de WhatsAppAPIClient
+El webhook se prueba con TestClient; el polling contra un gateway local (falso)
+que sirve una ráfaga de mensajes en /api/whatsapp/messages
+"""
+
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from whatsapp_client import WhatsAppAPIClient
+
+API_KEY = 'secreto'
+
+
+def message(i):
+    return {'id': f"msg-{i}", 'from': '51999999999@c.us', 'body': f"hola {i}"}
+
+
+async def post_webhook(requests):
+    """Enviar (payload, headers) en orden; devuelve [(status, json)] y los mensajes despachados"""
+    client = WhatsAppAPIClient('http://gateway.local', API_KEY)
+    received = []
+
+    async def callback(msg):
+        received.append(msg)
+
+    test_client = TestClient(TestServer(client.build_webhook_app(callback)))
+    await test_client.start_server()
+    results = []
+    try:
+        for payload, headers in requests:
+            response = await test_client.post('/webhook/whatsapp', json=payload, headers=headers)
+            results.append((response.status, await response.json()))
+    finally:
+        await test_client.close()
+    return results, received
+
+
+def test_webhook_rejects_bad_or_non_ascii_key():
+    results, received = asyncio.run(post_webhook([
+        (message(1), {}),
+        (message(1), {'X-API-Key': 'otra'}),
+        (message(1), {'X-API-Key': 'clavé'.encode('utf-8').decode('latin-1')}),
+    ]))
+    assert [status for status, _ in results] == [401, 401, 401]
+    assert received == []
+
+
+def test_webhook_suppresses_duplicates():
+    headers = {'X-API-Key': API_KEY}
+    results, received = asyncio.run(post_webhook([
+        (message(1), headers),
+        ({'data': [message(1), message(2)]}, headers),
+        ([message(2), message(2)], headers),
+    ]))
+    assert [body['accepted'] for _, body in results] == [1, 1, 0]
+    assert [body['duplicates'] for _, body in results] == [0, 1, 2]
+    assert [msg['id'] for msg in received] == ['msg-1', 'msg-2']
+
+
+def test_webhook_rejects_data_that_is_not_a_list():
+    results, received = asyncio.run(post_webhook([
+        ({'data': message(1)}, {'X-API-Key': API_KEY}),
+        ("texto", {'X-API-Key': API_KEY}),
+    ]))
+    assert [status for status, _ in results] == [400, 400]
+    assert received == []
+
+
+def test_webhook_counts_non_dict_items_as_invalid():
+    results, received = asyncio.run(post_webhook([
+        ({'data': [message(1), "msg-2", None, 3]}, {'X-API-Key': API_KEY}),
+    ]))
+    status, body = results[0]
+    assert status == 200
+    assert body == {'success': True, 'accepted': 1, 'duplicates': 0, 'invalid': 3}
+    assert [msg['id'] for msg in received] == ['msg-1']
+
+
+def test_polling_dispatches_burst_from_gateway():
+    """Una ráfaga de 50 mensajes se despacha en una sola consulta, sin esperas entre mensajes"""
+    burst = [message(i) for i in range(50)]
+    polls = []
+
+    async def messages(request):
+        polls.append(request.headers.get('X-API-Key'))
+        return web.json_response({'success': True, 'data': burst})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/whatsapp/messages', messages)
+        server = TestServer(app)
+        await server.start_server()
+        client = WhatsAppAPIClient(str(server.make_url('')), API_KEY)
+        received = []
+        done = asyncio.Event()
+
+        async def callback(msg):
+            received.append(msg)
+            if len(received) == len(burst):
+                done.set()
+
+        start = time.perf_counter()
+        poller = asyncio.create_task(client.start_polling_async(callback, min_interval=0.05, max_interval=0.1))
+        try:
+            await asyncio.wait_for(done.wait(), timeout=5)
+            elapsed = time.perf_counter() - start
+            # Siguientes consultas: mismos IDs, todos duplicados
+            await asyncio.sleep(0.15)
+        finally:
+            poller.cancel()
+            await client.close()
+            await server.close()
+        return received, elapsed, client
+
+    received, elapsed, client = asyncio.run(run())
+    assert [msg['id'] for msg in received] == [msg['id'] for msg in burst]
+    assert elapsed < 1.0
+    assert len(polls) >= 2 and polls[0] == API_KEY
+    assert client.processed_messages.duplicates_suppressed >= 50
@@ -5,31 +5,211 @@ Versión completa con soporte async
 
 import requests
 import aiohttp
+import asyncio
+import hmac
+import os
 import time
 import logging
 import re
 from typing import Optional, List, Dict
+from collections import OrderedDict
 from datetime import datetime
+from aiohttp import web
 
 logger = logging.getLogger(__name__)
 
 
+class MessageDedupStore:
+    """
+    IDs de mensajes ya procesados, acotados por tamaño y por antigüedad
+    
+    Mantiene el orden de inserción, así que siempre se descartan los IDs más
+    viejos; alta, consulta y expiración son O(1) (amortizado). Opcionalmente
+    persiste los IDs en un archivo para no reprocesar mensajes tras un
+    reinicio.
+    """
+    
+    def __init__(self, max_size: int = 5000, ttl: float = 86400, persist_path: Optional[str] = None):
+        """
+        Args:
+            max_size: IDs máximos en memoria
+            ttl: Segundos que se recuerda un ID
+            persist_path: Archivo donde persistir IDs (None = solo memoria)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self._seen = OrderedDict()  # id -> timestamp de alta
+        self._persisted_lines = 0
+        self.duplicates_suppressed = 0
+        
+        if persist_path:
+            self._load()
+    
+    def __contains__(self, msg_id) -> bool:
+        self._evict(time.time())
+        return msg_id in self._seen
+    
+    def __len__(self) -> int:
+        return len(self._seen)
+    
+    def add_if_new(self, msg_id) -> bool:
+        """
+        Registrar un ID
+        
+        Returns:
+            True si es nuevo, False si ya se había visto (duplicado)
+        """
+        now = time.time()
+        self._evict(now)
+        
+        if msg_id in self._seen:
+            self.duplicates_suppressed += 1
+            return False
+        
+        self._seen[msg_id] = now
+        self._evict(now)
+        self._append(msg_id, now)
+        return True
+    
+    def _evict(self, now: float):
+        while self._seen:
+            _, added_at = next(iter(self._seen.items()))
+            if len(self._seen) > self.max_size or now - added_at > self.ttl:
+                self._seen.popitem(last=False)
+            else:
+                break
+    
+    def _load(self):
+        """Recuperar IDs persistidos que sigan vigentes"""
+        if not os.path.exists(self.persist_path):
+            return
+        
+        now = time.time()
+        skipped = 0
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    # Una línea dañada (p. ej. escritura cortada) no invalida el resto
+                    try:
+                        msg_id, _, added_at = line.rstrip('\n').rpartition('\t')
+                        added_at = float(added_at)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    if msg_id and now - added_at <= self.ttl:
+                        self._seen[msg_id] = added_at
+                        self._seen.move_to_end(msg_id)
+            self._evict(now)
+            logger.info(f"📂 {len(self._seen)} IDs de mensajes recuperados de {self.persist_path}")
+            if skipped:
+                logger.warning(f"⚠️ {skipped} líneas inválidas ignoradas en {self.persist_path}")
+        except Exception as e:
+            logger.error(f"❌ Error leyendo {self.persist_path}: {e}")
+        
+        self._compact()
+    
+    def _append(self, msg_id, added_at: float):
+        if not self.persist_path:
+            return
+        
+        try:
+            # Reescribir solo los vigentes cuando el archivo duplica al máximo
+            if self._persisted_lines >= 2 * self.max_size:
+                self._compact()
+            else:
+                with open(self.persist_path, 'a', encoding='utf-8') as f:
+                    f.write(f"{msg_id}\t{added_at}\n")
+                self._persisted_lines += 1
+        except Exception as e:
+            logger.error(f"❌ Error persistiendo ID de mensaje: {e}")
+    
+    def _compact(self):
+        tmp_path = f"{self.persist_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for msg_id, added_at in self._seen.items():
+                    f.write(f"{msg_id}\t{added_at}\n")
+            os.replace(tmp_path, self.persist_path)
+            self._persisted_lines = len(self._seen)
+        except Exception as e:
+            logger.error(f"❌ Error compactando {self.persist_path}: {e}")
+    
+    def stats(self) -> dict:
+        return {
+            'size': len(self._seen),
+            'max_size': self.max_size,
+            'duplicates_suppressed': self.duplicates_suppressed
+        }
+
+
 class WhatsAppAPIClient:
     """Cliente para interactuar con la API de WhatsApp"""
     
-    def __init__(self, api_url: str, api_key: str):
+    def __init__(self, api_url: str, api_key: str,
+                 pool_limit: int = 100, pool_limit_per_host: int = 50,
+                 keepalive_timeout: float = 60, dns_cache_ttl: int = 300,
+                 dedup_max_size: int = 5000, dedup_ttl: float = 86400,
+                 dedup_path: Optional[str] = None):
         """
         Inicializar cliente
         
         Args:
             api_url: URL base de la API (ej: https://apiwsp.services.vridevops.space)
             api_key: API Key configurada en .env
+            pool_limit: Conexiones simultáneas máximas de la sesión async
+            pool_limit_per_host: Conexiones simultáneas máximas hacia la API
+            keepalive_timeout: Segundos que se mantiene viva una conexión ociosa
+            dns_cache_ttl: Segundos de caché DNS
+            dedup_max_size, dedup_ttl, dedup_path: Ver MessageDedupStore
         """
         self.api_url = api_url.rstrip('/')
         self.api_key = api_key
-        self.processed_messages = set()
+        self.processed_messages = MessageDedupStore(dedup_max_size, dedup_ttl, dedup_path)
         self.last_check = None
-        self.session = None  # Para requests async
+        self.session = None  # Sesión async compartida (ver _get_session)
+        self._session_loop = None
+        self._session_lock = None
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Sesión aiohttp compartida por todas las llamadas async
+        
+        Se crea la primera vez que se usa, en el event loop que está corriendo,
+        para reutilizar conexiones TCP/TLS entre mensajes.
+        """
+        loop = asyncio.get_running_loop()
+        if self.session is not None and not self.session.closed and self._session_loop is loop:
+            return self.session
+        
+        if self._session_lock is None:
+            self._session_lock = asyncio.Lock()
+        
+        async with self._session_lock:
+            if self.session is None or self.session.closed or self._session_loop is not loop:
+                connector = aiohttp.TCPConnector(
+                    limit=self.pool_limit,
+                    limit_per_host=self.pool_limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=self.dns_cache_ttl
+                )
+                self.session = aiohttp.ClientSession(connector=connector)
+                self._session_loop = loop
+                logger.info(f"🔌 Sesión HTTP WhatsApp creada (pool: {self.pool_limit_per_host}/host)")
+        
+        return self.session
+    
+    async def close(self):
+        """Cerrar la sesión async compartida"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
         
     def _get_headers(self) -> dict:
         """Headers comunes para todas las peticiones"""
@@ -133,22 +313,22 @@ class WhatsAppAPIClient:
             # Intentar marcar como leído en la API
             url = f"{self.api_url}/api/whatsapp/messages/{message_id}/read"
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=self._get_headers(),
-                    timeout=aiohttp.ClientTimeout(total=5)
-                ) as response:
-                    if response.status == 200:
-                        logger.debug(f"✅ Mensaje {message_id} marcado como leído")
-                        return True
-                    elif response.status == 404:
-                        # Si el endpoint no existe, solo loggear y continuar
-                        logger.debug(f"⚠️ Endpoint de marcar como leído no disponible")
-                        return True
-                    else:
-                        logger.warning(f"⚠️ Error marcando como leído: {response.status}")
-                        return True  # No bloquear el flujo
+            session = await self._get_session()
+            async with session.post(
+                url,
+                headers=self._get_headers(),
+                timeout=aiohttp.ClientTimeout(total=5)
+            ) as response:
+                if response.status == 200:
+                    logger.debug(f"✅ Mensaje {message_id} marcado como leído")
+                    return True
+                elif response.status == 404:
+                    # Si el endpoint no existe, solo loggear y continuar
+                    logger.debug(f"⚠️ Endpoint de marcar como leído no disponible")
+                    return True
+                else:
+                    logger.warning(f"⚠️ Error marcando como leído: {response.status}")
+                    return True  # No bloquear el flujo
                     
         except Exception as e:
             logger.debug(f"⚠️ No se pudo marcar como leído (no crítico): {str(e)}")
@@ -173,20 +353,20 @@ class WhatsAppAPIClient:
                 'message': message
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    json=payload,
-                    headers=self._get_headers(),
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
-                    if response.status == 200:
-                        logger.info(f"✅ Mensaje enviado a {to}")
-                        return True
-                    else:
-                        text = await response.text()
-                        logger.error(f"❌ Error enviando mensaje: {response.status} - {text}")
-                        return False
+            session = await self._get_session()
+            async with session.post(
+                url,
+                json=payload,
+                headers=self._get_headers(),
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                if response.status == 200:
+                    logger.info(f"✅ Mensaje enviado a {to}")
+                    return True
+                else:
+                    text = await response.text()
+                    logger.error(f"❌ Error enviando mensaje: {response.status} - {text}")
+                    return False
                     
         except Exception as e:
             logger.error(f"❌ Excepción al enviar mensaje async: {str(e)}")
@@ -214,20 +394,20 @@ class WhatsAppAPIClient:
             
             logger.info(f"📤 Enviando media a {to}: {media_url}")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    json=payload,
-                    headers=self._get_headers(),
-                    timeout=aiohttp.ClientTimeout(total=60)
-                ) as response:
-                    if response.status == 200:
-                        logger.info(f"✅ Media enviado a {to}")
-                        return True
-                    else:
-                        text = await response.text()
-                        logger.error(f"❌ Error enviando media: {response.status} - {text}")
-                        return False
+            session = await self._get_session()
+            async with session.post(
+                url,
+                json=payload,
+                headers=self._get_headers(),
+                timeout=aiohttp.ClientTimeout(total=60)
+            ) as response:
+                if response.status == 200:
+                    logger.info(f"✅ Media enviado a {to}")
+                    return True
+                else:
+                    text = await response.text()
+                    logger.error(f"❌ Error enviando media: {response.status} - {text}")
+                    return False
                     
         except Exception as e:
             logger.error(f"❌ Excepción al enviar media: {str(e)}")
@@ -288,28 +468,28 @@ class WhatsAppAPIClient:
             url = f"{self.api_url}/api/whatsapp/messages"
             params = {'limit': limit, 'unreadOnly': 'true'}
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    url,
-                    params=params,
-                    headers=self._get_headers(),
-                    timeout=aiohttp.ClientTimeout(total=10)
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
+            session = await self._get_session()
+            async with session.get(
+                url,
+                params=params,
+                headers=self._get_headers(),
+                timeout=aiohttp.ClientTimeout(total=10)
+            ) as response:
+                if response.status == 200:
+                    data = await response.json()
                         
-                        # Tu API devuelve en formato {"success": true, "data": [...]}
-                        messages = data.get('data', []) if data.get('success') else []
+                    # Tu API devuelve en formato {"success": true, "data": [...]}
+                    messages = data.get('data', []) if data.get('success') else []
                         
-                        if messages:
-                            logger.info(f"📬 Recibidos {len(messages)} mensajes")
-                            for msg in messages:
-                                logger.info(f"📄 Mensaje de {msg.get('from')}: {msg.get('body')}")
+                    if messages:
+                        logger.info(f"📬 Recibidos {len(messages)} mensajes")
+                        for msg in messages:
+                            logger.info(f"📄 Mensaje de {msg.get('from')}: {msg.get('body')}")
                         
-                        return messages
-                    else:
-                        logger.error(f"❌ Error obteniendo mensajes: {response.status}")
-                        return []
+                    return messages
+                else:
+                    logger.error(f"❌ Error obteniendo mensajes: {response.status}")
+                    return []
                     
         except Exception as e:
             logger.error(f"❌ Excepción al obtener mensajes async: {str(e)}")
@@ -334,9 +514,7 @@ class WhatsAppAPIClient:
                     msg_id = msg.get('id')
                     
                     # Evitar procesar mensajes duplicados
-                    if msg_id and msg_id not in self.processed_messages:
-                        self.processed_messages.add(msg_id)
-                        
+                    if self._mark_processed(msg_id):
                         # Log del mensaje que se va a procesar
                         logger.info(f"🔄 Procesando mensaje {msg_id}: {msg.get('body', '')[:30]}")
                         
@@ -348,16 +526,148 @@ class WhatsAppAPIClient:
                     else:
                         logger.debug(f"⏭️ Mensaje {msg_id} ya procesado, saltando...")
                 
-                # Limpiar mensajes procesados viejos (mantener solo últimos 500)
-                if len(self.processed_messages) > 500:
-                    oldest = list(self.processed_messages)[:-500]
-                    self.processed_messages -= set(oldest)
-                    logger.debug(f"🧹 Limpiados {len(oldest)} mensajes antiguos del cache")
-                
             except Exception as e:
                 logger.error(f"❌ Error en polling: {str(e)}")
             
             time.sleep(interval)
+    
+    def _mark_processed(self, msg_id) -> bool:
+        """
+        Registrar un ID de mensaje
+        
+        Returns:
+            True si es nuevo (hay que procesarlo), False si ya se vio
+        """
+        if not msg_id:
+            return False
+        return self.processed_messages.add_if_new(msg_id)
+    
+    async def start_polling_async(self, callback, min_interval: float = 0.5,
+                                  max_interval: float = 5.0, backoff: float = 2.0):
+        """
+        Polling de mensajes sobre el event loop (sin threads)
+        
+        El intervalo es adaptativo: vuelve a min_interval cuando llegan
+        mensajes y se multiplica por `backoff` en cada consulta vacía hasta
+        max_interval. Los mensajes nuevos se despachan de inmediato con
+        callback(msg), una corrutina que no debe bloquear.
+        
+        Args:
+            callback: async def callback(msg)
+            min_interval: Segundos entre consultas con tráfico
+            max_interval: Segundos máximos entre consultas en reposo
+            backoff: Factor de crecimiento del intervalo en reposo
+        """
+        logger.info(f"🔄 Iniciando polling async ({min_interval}s - {max_interval}s)...")
+        interval = min_interval
+        
+        while True:
+            try:
+                messages = await self.get_messages_async()
+                
+                dispatched = 0
+                for msg in messages:
+                    msg_id = msg.get('id')
+                    
+                    if not self._mark_processed(msg_id):
+                        logger.debug(f"⏭️ Mensaje {msg_id} ya procesado, saltando...")
+                        continue
+                    
+                    logger.info(f"🔄 Procesando mensaje {msg_id}: {msg.get('body', '')[:30]}")
+                    try:
+                        await callback(msg)
+                        dispatched += 1
+                    except Exception as e:
+                        logger.error(f"❌ Error en callback para {msg_id}: {str(e)}")
+                
+                interval = min_interval if dispatched else min(interval * backoff, max_interval)
+                
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error en polling async: {str(e)}")
+                interval = min(interval * backoff, max_interval)
+            
+            await asyncio.sleep(interval)
+
+    def build_webhook_app(self, callback, path: str = '/webhook/whatsapp',
+                          api_key: Optional[str] = None) -> web.Application:
+        """
+        App aiohttp que recibe eventos de mensajes empujados por el gateway
+        
+        Acepta un mensaje, una lista de mensajes o {"data": [...]} (mismo
+        formato que /api/whatsapp/messages). Valida la cabecera X-API-Key,
+        descarta IDs ya procesados y llama a callback(msg) por cada mensaje
+        nuevo, igual que start_polling_async.
+        
+        Args:
+            callback: async def callback(msg)
+            path: Ruta del endpoint POST
+            api_key: Clave esperada en X-API-Key (por defecto la del cliente)
+        """
+        expected_key = api_key or self.api_key
+        
+        async def receive(request: web.Request) -> web.Response:
+            # En bytes: compare_digest con str falla (TypeError) ante caracteres no ASCII
+            received_key = request.headers.get('X-API-Key', '').encode('utf-8')
+            if not expected_key or not hmac.compare_digest(received_key, expected_key.encode('utf-8')):
+                logger.warning(f"🚫 Webhook con API key inválida desde {request.remote}")
+                return web.json_response({'success': False, 'error': 'unauthorized'}, status=401)
+            
+            try:
+                payload = await request.json()
+            except Exception:
+                return web.json_response({'success': False, 'error': 'invalid json'}, status=400)
+            
+            if isinstance(payload, dict):
+                messages = payload['data'] if 'data' in payload else [payload]
+            elif isinstance(payload, list):
+                messages = payload
+            else:
+                return web.json_response({'success': False, 'error': 'invalid payload'}, status=400)
+            
+            if not isinstance(messages, list):
+                return web.json_response({'success': False, 'error': 'data must be a list'}, status=400)
+            
+            accepted = duplicates = invalid = 0
+            for msg in messages:
+                if not isinstance(msg, dict):
+                    invalid += 1
+                    continue
+                if not self._mark_processed(msg.get('id')):
+                    duplicates += 1
+                    continue
+                
+                logger.info(f"🪝 Webhook mensaje {msg.get('id')}: {msg.get('body', '')[:30]}")
+                try:
+                    await callback(msg)
+                    accepted += 1
+                except Exception as e:
+                    logger.error(f"❌ Error en callback para {msg.get('id')}: {str(e)}")
+            
+            if invalid:
+                logger.warning(f"⚠️ Webhook: {invalid} elementos que no son mensajes ignorados")
+            return web.json_response({'success': True, 'accepted': accepted,
+                                      'duplicates': duplicates, 'invalid': invalid})
+        
+        app = web.Application()
+        app.router.add_post(path, receive)
+        return app
+    
+    async def start_webhook(self, callback, host: str = '0.0.0.0', port: int = 8080,
+                            path: str = '/webhook/whatsapp',
+                            api_key: Optional[str] = None) -> web.AppRunner:
+        """
+        Levantar el endpoint de webhook (alternativa a start_polling_async)
+        
+        Returns:
+            AppRunner; llamar a runner.cleanup() al apagar
+        """
+        runner = web.AppRunner(self.build_webhook_app(callback, path, api_key))
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"🪝 Webhook escuchando en http://{host}:{port}{path}")
+        return runner
 
 async def send_media_url(self, phone: str, media_url: str, caption: str = "") -> bool:
     """